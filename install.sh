@@ -29,7 +29,7 @@ check_github
 # 1. 基础环境
 echo -e "${YELLOW}[1/6] 检查依赖...${NC}"
 if [ -f /etc/debian_version ]; then
-    apt-get update -y && apt-get install -y git python3 python3-pip curl tar
+    apt-get update -y && apt-get install -y git python3 python3-pip python3-dbus curl tar
 elif [ -f /etc/redhat-release ]; then
     yum install -y git python3 python3-pip curl tar
 fi
@@ -43,7 +43,7 @@ if [ ! -d "$INSTALL_DIR" ]; then echo -e "${RED}克隆失败${NC}"; exit 1; fi
 
 # 3. Python 依赖
 echo -e "${YELLOW}[3/6] 安装 Python 库...${NC}"
-pip3 install Flask requests psutil PyYAML
+pip3 install Flask requests psutil PyYAML waitress
 
 # 4. 下载核心
 echo -e "${YELLOW}[4/6] 安装 Sing-box 核心...${NC}"
@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""订阅处理性能基准：生成合成订阅，用本地 HTTP 服务提供拉取，
+测量解析 / 命名 / 节点存取 / API 的耗时与峰值内存，结果输出为 JSON 便于对比回归。
+
+  python3 sb-bench.py                              # 默认规模
+  python3 sb-bench.py --sizes 100,5000 --rules 50000 --out bench.json
+  python3 sb-bench.py --mix vmess=3,trojan=1 --only parse,api
+"""
+import os, sys, json, base64, time, random, argparse, tempfile, shutil, threading, tracemalloc
+import importlib.util, platform, statistics, subprocess, hashlib
+from urllib.parse import quote
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import yaml
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+PROTOCOLS = ("vmess", "vless", "trojan", "hy2", "tuic")
+SUITES = ("parse", "clash", "tag", "store", "api")
+
+# ====== 合成订阅 ======
+def gen_link(rnd, proto:str, i:int) -> str:
+    host=f"n{i}.{rnd.choice(['hk','jp','sg','us','tw'])}.example.com"
+    port=rnd.choice([443, 8443, 2053, 10000+i%5000])
+    name=f"{rnd.choice(['香港','日本','新加坡','美国','台湾'])} {i:05d} [{proto}]"
+    q=lambda s: quote(s, safe="")
+    if proto=="vmess":
+        js={"v":"2","ps":name,"add":host,"port":port,"id":f"{i:08x}-0000-4000-8000-{rnd.getrandbits(48):012x}",
+            "net":rnd.choice(["ws","tcp"]),"path":f"/v{i}","host":host,"tls":"tls","sni":host}
+        return "vmess://"+base64.b64encode(json.dumps(js, ensure_ascii=False).encode()).decode()
+    if proto=="vless":
+        sec=rnd.choice(["tls","reality"])
+        extra="&pbk=Zk9SjfMq8hY3GQ&sid=6ba85179&fp=chrome" if sec=="reality" else "&fp=chrome"
+        return f"vless://{i:08x}-1111-4000-8000-000000000000@{host}:{port}?security={sec}&sni={host}&type=tcp&flow=xtls-rprx-vision{extra}#{q(name)}"
+    if proto=="trojan":
+        return f"trojan://pw{i}@{host}:{port}?sni={host}&type=ws&path=%2Fws{i}&allowInsecure=1#{q(name)}"
+    if proto=="hy2":
+        return f"hy2://pw{i}@{host}:{port}?sni={host}&insecure=1#{q(name)}"
+    return f"tuic://{i:08x}-2222-4000-8000-000000000000:pw{i}@{host}:{port}?alpn=h3&congestion_control=bbr#{q(name)}"
+
+def gen_links(n:int, mix:dict, seed=1) -> list:
+    """按比例混合各协议生成 n 条分享链接（固定种子，结果可复现）"""
+    rnd=random.Random(seed)
+    protos=[p for p,w in mix.items() for _ in range(w)]
+    return [gen_link(rnd, protos[i%len(protos)], i) for i in range(n)]
+
+def gen_clash(n:int, rules:int, seed=1) -> str:
+    """Clash YAML：n 个节点 + 分组 + rules 条规则（规则放在 proxies 后面，和常见机场订阅一致）"""
+    rnd=random.Random(seed)
+    types=["vmess","vless","trojan","hysteria2","tuic"]
+    proxies=[]
+    for i in range(n):
+        t=types[i%len(types)]; host=f"c{i}.example.com"
+        p={"name":f"节点 {i:05d}","type":t,"server":host,"port":rnd.choice([443,8443])}
+        if t in ("vmess","vless"): p.update(uuid=f"{i:08x}-3333-4000-8000-000000000000", tls=True,
+                                            network="ws", **{"ws-opts":{"path":f"/c{i}","headers":{"Host":host}}})
+        elif t=="tuic": p.update(uuid=f"{i:08x}-4444-4000-8000-000000000000", password=f"p{i}")
+        else: p.update(password=f"p{i}", sni=host)
+        proxies.append(p)
+    names=[p["name"] for p in proxies]
+    doc={"port":7890,"mode":"rule","proxies":proxies,
+         "proxy-groups":[{"name":"auto","type":"url-test","proxies":names,"url":"http://www.gstatic.com/generate_204"}],
+         "rules":[f"DOMAIN-SUFFIX,d{i}.example.org,{'auto' if i%3 else 'DIRECT'}" for i in range(rules)]+["MATCH,auto"]}
+    return yaml.safe_dump(doc, allow_unicode=True, sort_keys=False)
+
+def corpus(n:int, mix:dict, rules:int) -> dict:
+    """路径 -> 正文字节"""
+    plain="\n".join(gen_links(n, mix)).encode()
+    clash=gen_clash(n, rules).encode()
+    return {f"/plain/{n}":plain, f"/b64/{n}":base64.b64encode(plain),
+            f"/clash/{n}":clash, f"/clash-b64/{n}":base64.b64encode(clash)}
+
+# ====== 本地订阅服务 ======
+class SubServer:
+    """ThreadingHTTPServer 提供 BODIES，支持 ETag / If-None-Match"""
+    def __init__(self):
+        self.bodies={}
+        bodies=self.bodies
+        class H(BaseHTTPRequestHandler):
+            protocol_version="HTTP/1.1"
+            def log_message(self, *a): pass
+            def do_GET(self):
+                body=bodies.get(self.path)
+                if body is None:
+                    self.send_response(404); self.send_header("Content-Length","0"); self.end_headers(); return
+                etag='"%s"' % hashlib.sha1(body).hexdigest()[:16]
+                if self.headers.get("If-None-Match")==etag:
+                    self.send_response(304); self.send_header("ETag",etag); self.send_header("Content-Length","0")
+                    self.end_headers(); return
+                self.send_response(200); self.send_header("ETag",etag)
+                self.send_header("Content-Type","text/plain"); self.send_header("Content-Length",str(len(body)))
+                self.end_headers(); self.wfile.write(body)
+        self.httpd=ThreadingHTTPServer(("127.0.0.1", 0), H)
+        self.httpd.daemon_threads=True
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def url(self, path): return f"http://127.0.0.1:{self.httpd.server_address[1]}{path}"
+    def close(self): self.httpd.shutdown(); self.httpd.server_close()
+
+# ====== 被测模块 ======
+def load_app(workdir:str, parse_cache:bool):
+    """把 sb-web.py 作为模块加载，所有文件都指到临时目录"""
+    cfg=os.path.join(workdir, "sing-box_config.json")
+    shutil.copy(os.path.join(HERE, "sing-box_config.json"), cfg)
+    os.environ["SB_CFG"]=cfg
+    os.environ["SB_WEB_TOKEN"]="bench"
+    if not parse_cache: os.environ["SB_PARSE_CACHE_SIZE"]="0"
+    spec=importlib.util.spec_from_file_location("sbweb", os.path.join(HERE, "sb-web.py"))
+    m=importlib.util.module_from_spec(spec); sys.modules["sbweb"]=m; spec.loader.exec_module(m)
+    for a in ("STATE_FILE","NODES_FILE","TRAFFIC_FILE","PARSE_CACHE_FILE"):
+        if hasattr(m, a): setattr(m, a, os.path.join(workdir, os.path.basename(getattr(m, a))))
+    return m
+
+def reset_caches(m):
+    """冷启动：清掉解析缓存和节点/状态的内存副本"""
+    pc=getattr(m, "_PARSE_CACHE", None)
+    if pc is not None:
+        with pc.lock: pc.data.clear()
+    if hasattr(m, "_NODE_STORE"): m._NODE_STORE.sig=None
+    if hasattr(m, "_STATE_STORE"):
+        m._STATE_STORE.flush(); m._STATE_STORE.sig=None
+
+# ====== 计时 ======
+def measure(fn, repeat:int, setup=None, memory=True) -> dict:
+    """跑 repeat 次取耗时；再单独跑一次 tracemalloc 取峰值内存（tracemalloc 会拖慢，不计入耗时）"""
+    times=[]; out=None
+    for _ in range(repeat):
+        if setup: setup()
+        t0=time.perf_counter(); out=fn(); times.append((time.perf_counter()-t0)*1000)
+    r={"runs":repeat,"min_ms":round(min(times),3),"median_ms":round(statistics.median(times),3),
+       "max_ms":round(max(times),3)}
+    if memory:
+        if setup: setup()
+        tracemalloc.start()
+        try: fn(); _, peak=tracemalloc.get_traced_memory()
+        finally: tracemalloc.stop()
+        r["peak_kb"]=round(peak/1024, 1)
+    if isinstance(out, (list, tuple)): r["items"]=len(out)
+    return r
+
+def bench(args) -> dict:
+    mix={p:1 for p in PROTOCOLS}
+    if args.mix:
+        mix={}
+        for kv in args.mix.split(","):
+            k,_,w=kv.partition("="); k=k.strip()
+            if k not in PROTOCOLS: sys.exit(f"未知协议: {k}（可选 {', '.join(PROTOCOLS)}）")
+            mix[k]=int(w or 1)
+    sizes=[int(x) for x in args.sizes.split(",") if x]
+    only=set(args.only.split(",")) if args.only else set(SUITES)
+    workdir=tempfile.mkdtemp(prefix="sb-bench-")
+    srv=SubServer()
+    results=[]
+    def add(name, size, r, **kw):
+        row={"name":name,"size":size,**kw,**r}; results.append(row)
+        if not args.quiet:
+            extra=f" peak={row['peak_kb']}KB" if "peak_kb" in row else ""
+            print(f"  {name:<28} n={size:<7} {' '.join(f'{k}={v}' for k,v in kw.items()):<16} "
+                  f"median={row['median_ms']}ms{extra}", file=sys.stderr)
+    try:
+        m=load_app(workdir, not args.no_parse_cache)
+        cache_modes=[("cold", lambda: reset_caches(m))]
+        if getattr(m, "_PARSE_CACHE", None) is not None and not args.no_parse_cache:
+            cache_modes.append(("warm", None))
+        for n in sizes:
+            srv.bodies.update(corpus(n, mix, args.rules))
+            if "parse" in only:
+                for fmt in ("plain","b64","clash","clash-b64"):
+                    url=srv.url(f"/{fmt}/{n}")
+                    for mode, setup in cache_modes:
+                        add("parse_subscription", n, measure(lambda: m.parse_subscription(url), args.repeat, setup),
+                            format=fmt, cache=mode)
+            if "clash" in only:
+                text=srv.bodies[f"/clash/{n}"].decode()
+                for mode, setup in cache_modes:
+                    add("parse_clash_yaml", n, measure(lambda: m.parse_clash_yaml(text), args.repeat, setup),
+                        rules=args.rules, cache=mode)
+                if hasattr(m, "clash_proxies"):
+                    add("clash_proxies", n, measure(lambda: m.clash_proxies(text), args.repeat), rules=args.rules)
+                add("yaml.safe_load", n, measure(lambda: yaml.safe_load(text), args.repeat, memory=False),
+                    rules=args.rules)
+            if "tag" in only:
+                # 大量重名（订阅里常见的 "香港 01" 重复多次）
+                names=[f"HK-{i%max(1,n//20)}" for i in range(n)]
+                def tag_all():
+                    used=m.TagSet()
+                    return [m.normalize_tag(x, used) for x in names]
+                add("normalize_tag", n, measure(tag_all, args.repeat), dup_ratio=20)
+            if "store" in only or "api" in only:
+                reset_caches(m)
+                nodes=m.parse_subscription(srv.url(f"/plain/{n}"))
+                used=m.TagSet()
+                for ob in nodes: ob["tag"]=m.normalize_tag(ob.get("tag"), used)
+            if "store" in only:
+                add("nodes_save", n, measure(lambda: m.nodes_save(nodes), args.repeat))
+                def cold_store(): m._NODE_STORE.sig=None
+                add("nodes_load", n, measure(m.nodes_load, args.repeat,
+                                             cold_store if hasattr(m, "_NODE_STORE") else None), cache="cold")
+                add("nodes_load", n, measure(m.nodes_load, args.repeat), cache="warm")
+            if "api" in only:
+                c=m.app.test_client(); h={"X-Token":"bench"}
+                def call(path, body):
+                    def f():
+                        r=c.post(path, headers=h, json=body)
+                        if r.status_code!=200: raise RuntimeError(f"{path}: HTTP {r.status_code} {r.get_data(as_text=True)[:200]}")
+                        return r
+                    return f
+                urls=[srv.url(f"/plain/{n}"), srv.url(f"/clash/{n}")]
+                add("POST /api/sub/fetch", n, measure(call("/api/sub/fetch", {"urls":urls,"force":True}), args.repeat,
+                                                      lambda: reset_caches(m)), force=True)
+                add("POST /api/sub/fetch", n, measure(call("/api/sub/fetch", {"urls":urls}), args.repeat), force=False)
+                add("POST /api/init", n, measure(call("/api/init", {}), args.repeat))
+                if "/api/nodes" in {r.rule for r in m.app.url_map.iter_rules()}:
+                    add("POST /api/nodes", n, measure(call("/api/nodes", {"q":"香港","sort":"name","page":2}),
+                                                      args.repeat))
+            for k in [k for k in srv.bodies if k.endswith(f"/{n}")]: del srv.bodies[k]
+    finally:
+        srv.close()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    try: rev=subprocess.run(["git","-C",HERE,"rev-parse","--short","HEAD"], capture_output=True, text=True).stdout.strip()
+    except OSError: rev=""
+    return {"meta":{"ts":int(time.time()),"git":rev,"python":platform.python_version(),
+                    "machine":platform.machine(),"libyaml":bool(getattr(yaml,"__with_libyaml__",False)),
+                    "sizes":sizes,"mix":mix,"rules":args.rules,"repeat":args.repeat,
+                    "parse_cache":not args.no_parse_cache},
+            "results":results}
+
+def main():
+    ap=argparse.ArgumentParser(description="sing-box-web 订阅处理基准")
+    ap.add_argument("--sizes", default="100,1000,10000", help="节点数，逗号分隔")
+    ap.add_argument("--mix", default="", help="协议比例，如 vmess=2,vless=1,trojan=1,hy2=1,tuic=1")
+    ap.add_argument("--rules", type=int, default=20000, help="Clash YAML 的规则条数")
+    ap.add_argument("--repeat", type=int, default=3)
+    ap.add_argument("--only", default="", help="只跑部分：" + ",".join(SUITES))
+    ap.add_argument("--no-parse-cache", action="store_true", help="关闭解析结果缓存")
+    ap.add_argument("--out", default="", help="结果 JSON 文件（默认输出到 stdout）")
+    ap.add_argument("--quiet", action="store_true")
+    args=ap.parse_args()
+    res=bench(args)
+    raw=json.dumps(res, ensure_ascii=False, indent=1)
+    if args.out:
+        with open(args.out, "w") as f: f.write(raw+"\n")
+    else:
+        print(raw)
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,18 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
-import os, json, base64, re, shlex, subprocess, urllib.request, urllib.parse
+import os, json, base64, re, shlex, subprocess, urllib.request, urllib.parse, itertools
+import hashlib, tempfile, urllib.error, atexit, functools
 import yaml
-import socket, psutil ,time, re
-from flask import Flask, request, jsonify, render_template
+import socket, psutil ,time, re, ssl, threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, Future, wait
+import queue, signal, uuid, bisect, sys, shutil, argparse
+from array import array
+from flask import Flask, request, jsonify, render_template, Response
+try:
+    import dbus    # python3-dbus，可选；没有时回退到 systemctl show
+except ImportError:
+    dbus = None
 
 # ====== 配置（可用 systemd Environment 覆盖） ======
 HOST     = os.environ.get("SB_WEB_HOST", "0.0.0.0")
@@ -16,6 +25,13 @@ SB_SVC   = os.environ.get("SB_SERVICE", "sing-box")
 SB_CFG   = os.environ.get("SB_CFG", "/opt/sing-box-web/sing-box_config.json")
 SB_BIN   = os.environ.get("SB_BIN", "/opt/sing-box-web/sing-box")
 
+# 启停时的网络设置：builtin 由本程序一次性提交整套 NAT/DNS 规则；script 沿用 SB_START/SB_STOP 脚本
+NET_MODE    = os.environ.get("SB_NET", "builtin")
+NET_BACKEND = os.environ.get("SB_NET_BACKEND", "auto")      # auto / iptables / nft
+NET_LAN     = os.environ.get("SB_NET_LAN", "")              # 只重定向该网段的 DNS；空 = 出网口的直连网段
+NET_STATE   = os.environ.get("SB_NET_STATE", "/run/sb-guard.state")
+NET_PERSIST = os.environ.get("SB_NET_PERSIST", "false").lower() in ("true","1","yes")   # 启停后 netfilter-persistent save
+
 INJECT_RESOLVER_TAG = os.environ.get("SB_RESOLVER_TAG", "cn-dns")
 INJECT_IFACE        = os.environ.get("SB_IFACE", "eth0")
 
@@ -26,7 +42,94 @@ MULTIPLEX_MAX_CONN = int(os.environ.get("SB_MULTIPLEX_MAX_CONN", "4"))
 MULTIPLEX_MIN_STREAMS = int(os.environ.get("SB_MULTIPLEX_MIN_STREAMS", "4"))
 MULTIPLEX_MAX_STREAMS = int(os.environ.get("SB_MULTIPLEX_MAX_STREAMS", "0"))
 
-STATE_FILE = "/opt/sing-box-web/sb-web-state.json"   # {"sub_url":"...","last_node_tag":"..."}
+# 节点探测（DNS + TCP + 可选 TLS 握手）
+PROBE_WORKERS = int(os.environ.get("SB_PROBE_WORKERS", "64"))
+PROBE_TIMEOUT = float(os.environ.get("SB_PROBE_TIMEOUT", "3"))
+PROBE_TTL     = int(os.environ.get("SB_PROBE_TTL", "300"))
+PROBE_TLS     = os.environ.get("SB_PROBE_TLS", "false").lower() in ("true", "1", "yes")
+
+# 服务模式：dev 为 Flask 自带开发服务器；prod 为线程池服务器（waitress 可用时支持 keep-alive）并优雅退出
+WEB_SERVER    = os.environ.get("SB_WEB_SERVER", "dev").lower()
+WEB_THREADS   = int(os.environ.get("SB_WEB_THREADS", "16"))
+WEB_WORKERS   = int(os.environ.get("SB_WEB_WORKERS", "1"))
+WEB_KEEPALIVE = int(os.environ.get("SB_WEB_KEEPALIVE", "15"))
+WEB_GRACE     = float(os.environ.get("SB_WEB_GRACE", "30"))
+# SSE 每个订阅会一直占着一个请求线程；超过上限返回 503，页面改为轮询，保证 API 始终有空闲线程
+WEB_SSE_MAX   = int(os.environ.get("SB_WEB_SSE_MAX", str(max(1, WEB_THREADS//4))))
+JOB_WORKERS   = int(os.environ.get("SB_JOB_WORKERS", "2"))
+
+# 节点列表分页
+NODE_PAGE_SIZE = int(os.environ.get("SB_NODE_PAGE_SIZE", "200"))
+
+# 多订阅并发拉取
+SUB_WORKERS = int(os.environ.get("SB_SUB_WORKERS", "4"))
+SUB_TIMEOUT = float(os.environ.get("SB_SUB_TIMEOUT", "25"))
+SUB_RETRIES = int(os.environ.get("SB_SUB_RETRIES", "2"))
+
+# 解析结果缓存：同一条分享链接/Clash 节点不重复解析（0 关闭）；可选落盘，重启后仍可命中
+PARSE_CACHE_SIZE    = int(os.environ.get("SB_PARSE_CACHE_SIZE", "20000"))
+PARSE_CACHE_PERSIST = os.environ.get("SB_PARSE_CACHE_PERSIST", "false").lower() in ("true", "1", "yes")
+
+# 快速切换：全部节点写进配置，main-out 为 selector，经 Clash API 切换，无需重启
+FAST_SWITCH  = os.environ.get("SB_FAST_SWITCH", "false").lower() in ("true", "1", "yes")
+# 批量应用：选中的节点放进 urltest 组（由 sing-box 自动选最快），main-out 为 selector 可手动覆盖
+URLTEST_TAG       = os.environ.get("SB_URLTEST_TAG", "auto")
+URLTEST_INTERVAL  = os.environ.get("SB_URLTEST_INTERVAL", "3m")
+URLTEST_TOLERANCE = int(os.environ.get("SB_URLTEST_TOLERANCE", "50"))
+CLASH_API    = os.environ.get("SB_CLASH_API", "127.0.0.1:9090")
+CLASH_SECRET = os.environ.get("SB_CLASH_SECRET", "")
+
+# 自动择优 / 故障切换
+FAILOVER          = os.environ.get("SB_FAILOVER", "false").lower() in ("true", "1", "yes")
+FAILOVER_INTERVAL = int(os.environ.get("SB_FAILOVER_INTERVAL", "60"))     # 检测周期（秒）
+FAILOVER_POOL     = int(os.environ.get("SB_FAILOVER_POOL", "8"))          # 候选节点数
+FAILOVER_MAX_MS   = float(os.environ.get("SB_FAILOVER_MAX_MS", "1500"))   # TCP+TLS 建连超过即视为劣化
+FAILOVER_ROUNDS   = int(os.environ.get("SB_FAILOVER_ROUNDS", "3"))        # 连续劣化几轮才切换
+FAILOVER_MARGIN   = float(os.environ.get("SB_FAILOVER_MARGIN", "0.3"))    # 候选须快出的比例
+FAILOVER_HOLD     = int(os.environ.get("SB_FAILOVER_HOLD", "600"))        # 两次切换最短间隔（秒）
+FAILOVER_URL      = os.environ.get("SB_FAILOVER_URL", "https://www.gstatic.com/generate_204")
+URLTEST_URL       = os.environ.get("SB_URLTEST_URL", FAILOVER_URL)
+
+# 流量统计（按出站/规则/客户端，数据来自 Clash API）
+TRAFFIC_INTERVAL = float(os.environ.get("SB_TRAFFIC_INTERVAL", "2"))
+TRAFFIC_ROLLUP   = int(os.environ.get("SB_TRAFFIC_ROLLUP", "300"))
+TRAFFIC_FILE     = "/opt/sing-box-web/sb-web-traffic.json"
+PARSE_CACHE_FILE = "/opt/sing-box-web/sb-web-parsecache.json"
+SPEED_FILE       = "/opt/sing-box-web/sb-web-speed.json"
+
+# 节点域名解析：并发数、成功/失败结果缓存时间（秒）、默认策略（节点自带 domain_strategy 时以节点为准）
+DNS_WORKERS  = int(os.environ.get("SB_DNS_WORKERS", "16"))
+DNS_TTL      = int(os.environ.get("SB_DNS_TTL", "600"))
+DNS_NEG_TTL  = int(os.environ.get("SB_DNS_NEG_TTL", "60"))
+DNS_STRATEGY = os.environ.get("SB_DNS_STRATEGY", "ipv4_only")
+
+# 规则集：远程 .srs 在后台按条件请求下载到本地，配置改为引用本地文件（sing-box 启动时不再等下载）
+RULESET_DIR      = os.environ.get("SB_RULESET_DIR", "/opt/sing-box-web/rules")
+RULESET_INTERVAL = int(os.environ.get("SB_RULESET_INTERVAL", "86400"))   # 检查更新周期（秒），0 关闭后台更新
+RULESET_LOCAL    = os.environ.get("SB_RULESET_LOCAL", "true").lower() in ("true", "1", "yes")
+
+# sing-box DNS 统计：订阅 Clash API /logs 解析缓存命中与上游耗时（需 log.level=debug），并定时经 /dns/query 主动探测
+DNSSTAT_ENABLE   = os.environ.get("SB_DNSSTAT", "true").lower() in ("true", "1", "yes")
+DNSSTAT_PROBE    = [x.strip() for x in os.environ.get("SB_DNSSTAT_PROBE", "www.google.com,www.baidu.com").split(",") if x.strip()]
+DNSSTAT_INTERVAL = int(os.environ.get("SB_DNSSTAT_INTERVAL", "300"))   # 主动探测周期（秒），0 关闭
+
+# /metrics（OpenMetrics）：默认与 API 一样要令牌（X-Token / Authorization: Bearer / ?token=）
+METRICS_PUBLIC = os.environ.get("SB_METRICS_PUBLIC", "false").lower() in ("true", "1", "yes")
+
+# 测速：临时起一个只监听 127.0.0.1 的 sing-box（mixed 入站 -> 被测节点），经它下载/上传测吞吐
+SPEED_DOWN_URL    = os.environ.get("SB_SPEED_DOWN_URL", "https://speed.cloudflare.com/__down?bytes={bytes}")
+SPEED_UP_URL      = os.environ.get("SB_SPEED_UP_URL", "https://speed.cloudflare.com/__up")
+SPEED_DOWN_BYTES  = int(os.environ.get("SB_SPEED_DOWN_BYTES", str(10<<20)))   # 每个节点最多下载
+SPEED_UP_BYTES    = int(os.environ.get("SB_SPEED_UP_BYTES", str(2<<20)))      # 每个节点上传（0 不测上传）
+SPEED_MAX_BYTES   = int(os.environ.get("SB_SPEED_MAX_BYTES", str(200<<20)))   # 单个任务总流量上限
+SPEED_TIMEOUT     = float(os.environ.get("SB_SPEED_TIMEOUT", "15"))           # 每个方向最长测多久（秒）
+SPEED_CONCURRENCY = int(os.environ.get("SB_SPEED_CONCURRENCY", "2"))          # 同时测几个节点（全局）
+SPEED_HALFLIFE    = float(os.environ.get("SB_SPEED_HALFLIFE", "259200"))      # 历史得分半衰期（秒）
+
+# 服务状态 / 默认路由缓存时间（秒）
+SVC_TTL = float(os.environ.get("SB_SVC_TTL", "2"))
+
+STATE_FILE = "/opt/sing-box-web/sb-web-state.json"   # {"sub_url":"...","sub_urls":[...],"last_node_tag":"..."}
 NODES_FILE = "/opt/sing-box-web/sb-web-nodes.json"   # {"nodes":[ ...sing-box outbounds... ]}
 
 app = Flask(__name__, template_folder="templates", static_folder="static")
@@ -35,15 +138,186 @@ app = Flask(__name__, template_folder="templates", static_folder="static")
 def ok(msg="", **kw): d={"ok":True,"msg":msg}; d.update(kw); return jsonify(d)
 def err(msg="", **kw): d={"ok":False,"msg":msg}; d.update(kw); return jsonify(d), 400
 def authed(): return TOKEN and request.headers.get("X-Token","")==TOKEN
+def respond(r:dict):
+    """{"ok","msg",...} 结果字典 -> 响应"""
+    r=dict(r); return (ok if r.pop("ok") else err)(r.pop("msg",""), **r)
 
-# 获取默认网卡的辅助函数 (保持不变)
-def get_default_interface():
+# ====== 可观测性：OpenMetrics 指标 ======
+# 指标在模块加载时注册；每个标签组合的子项第一次用到时创建并缓存（标签串也预先拼好），
+# 之后 inc/observe 只是加锁加数，不再分配字典
+class _Child:
+    __slots__=("lock","value","sum","counts","lbl")
+    def __init__(self, lbl:str, nb:int=0):
+        self.lock=threading.Lock(); self.value=0.0; self.sum=0.0
+        self.counts=[0]*nb; self.lbl=lbl
+
+class Metric:
+    def __init__(self, name:str, kind:str, help:str, labels=(), buckets=None, fn=None):
+        self.name, self.kind, self.help, self.labelnames = name, kind, help, tuple(labels)
+        self.buckets=tuple(buckets or ()); self.fn=fn
+        self.children={}; self.lock=threading.Lock()
+        _METRICS.append(self)
+
+    def labels(self, *vals) -> _Child:
+        c=self.children.get(vals)
+        if c is None:
+            with self.lock:
+                c=self.children.get(vals)
+                if c is None:
+                    lbl=",".join(f'{k}="{_om_escape(str(v))}"' for k,v in zip(self.labelnames, vals))
+                    c=self.children[vals]=_Child(lbl, len(self.buckets)+1)
+        return c
+
+    def inc(self, c:_Child, v=1.0):
+        with c.lock: c.value+=v
+
+    def set(self, c:_Child, v):
+        c.value=v
+
+    def observe(self, c:_Child, v:float):
+        i=bisect.bisect_left(self.buckets, v)
+        with c.lock: c.counts[i]+=1; c.sum+=v
+
+    def render(self, out:list):
+        base=self.name[:-6] if self.kind=="counter" and self.name.endswith("_total") else self.name
+        out.append(f"# TYPE {base} {self.kind}\n# HELP {base} {self.help}\n")
+        if self.fn:
+            try: rows=self.fn()
+            except Exception: rows=[]
+            for vals, v in rows:
+                if v is None: continue
+                lbl=",".join(f'{k}="{_om_escape(str(x))}"' for k,x in zip(self.labelnames, vals))
+                out.append(f"{self.name}{{{lbl}}} {v}\n" if lbl else f"{self.name} {v}\n")
+            return
+        for c in list(self.children.values()):
+            if self.kind=="histogram":
+                with c.lock: counts=list(c.counts); total=c.sum
+                sep="," if c.lbl else ""
+                acc=0
+                for le,n in zip(self.buckets+(float("inf"),), counts):
+                    acc+=n
+                    out.append(f'{base}_bucket{{{c.lbl}{sep}le="{"+Inf" if le==float("inf") else le}"}} {acc}\n')
+                lb=f"{{{c.lbl}}}" if c.lbl else ""
+                out.append(f"{base}_count{lb} {acc}\n{base}_sum{lb} {total}\n")
+            else:
+                lb=f"{{{c.lbl}}}" if c.lbl else ""
+                out.append(f"{self.name}{lb} {c.value}\n")
+
+_METRICS = []
+def _om_escape(v:str) -> str:
+    return v.replace("\\","\\\\").replace("\n","\\n").replace('"','\\"')
+
+def metrics_render() -> str:
+    out=[]
+    for m in _METRICS: m.render(out)
+    out.append("# EOF\n")
+    return "".join(out)
+
+class timed:
+    """with timed(HIST, child): ... 记录耗时（秒）"""
+    __slots__=("m","c","t0")
+    def __init__(self, m:Metric, c:_Child): self.m, self.c = m, c
+    def __enter__(self): self.t0=time.perf_counter(); return self
+    def __exit__(self, *a): self.m.observe(self.c, time.perf_counter()-self.t0)
+
+_LAT_BUCKETS  = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+_FAST_BUCKETS = (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05)
+
+M_HTTP_SECONDS = Metric("sbweb_http_request_duration_seconds", "histogram", "HTTP 请求耗时", ("endpoint",), _LAT_BUCKETS)
+M_HTTP_TOTAL   = Metric("sbweb_http_requests_total", "counter", "HTTP 请求数", ("endpoint","code"))
+M_SUB_SECONDS  = Metric("sbweb_sub_fetch_duration_seconds", "histogram", "单个订阅拉取+解析耗时", ("result",), _LAT_BUCKETS)
+M_SUB_BYTES    = Metric("sbweb_sub_fetch_bytes_total", "counter", "订阅正文字节数")
+M_PARSE_SECONDS= Metric("sbweb_parse_duration_seconds", "histogram", "单个节点解析耗时", ("proto",), _FAST_BUCKETS)
+M_YAML_SECONDS = Metric("sbweb_clash_yaml_duration_seconds", "histogram", "Clash YAML 读取 proxies 段耗时", (), _LAT_BUCKETS)
+M_APPLY_SECONDS= Metric("sbweb_apply_duration_seconds", "histogram", "切换节点各阶段耗时", ("phase",), _LAT_BUCKETS)
+M_APPLY_TOTAL  = Metric("sbweb_apply_total", "counter", "切换节点次数", ("mode","result"))
+M_CHECK_TOTAL  = Metric("sbweb_config_check_total", "counter", "配置校验次数（hit 为命中缓存）", ("result",))
+M_PROC_TOTAL   = Metric("sbweb_subprocess_total", "counter", "子进程调用次数", ("cmd","result"))
+M_PROC_SECONDS = Metric("sbweb_subprocess_duration_seconds", "histogram", "子进程耗时", ("cmd",), _LAT_BUCKETS)
+M_SUB_BYTES_C  = M_SUB_BYTES.labels()
+for _p in ("vmess","vless","trojan","hysteria2","tuic"): M_PARSE_SECONDS.labels(_p)
+for _p in ("write","check","restart","total"): M_APPLY_SECONDS.labels(_p)
+for _p in ("hit","miss"): M_CHECK_TOTAL.labels(_p)
+
+# ====== 后台任务 ======
+# 耗时操作（拉订阅、切换节点……）可以提交为任务立即返回，前端再查 /api/jobs/<id>
+_JOB_POOL = ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix="job")
+_JOBS = {}
+_JOBS_LOCK = threading.Lock()
+_SHUTDOWN = threading.Event()
+
+def job_submit(kind:str, fn, *args, **kw) -> str:
+    """提交任务；fn 返回 {"ok","msg",...}，可通过 job_progress() 汇报进度"""
+    jid=uuid.uuid4().hex[:12]
+    job={"id":jid,"kind":kind,"state":"queued","progress":None,"result":None,
+         "created":time.time(),"started":None,"finished":None}
+    with _JOBS_LOCK:
+        _JOBS[jid]=job
+        # 只淘汰已结束的旧任务；排队 / 运行中的必须还能查到
+        done=sorted((j for j in _JOBS.values() if j["finished"] is not None), key=lambda j:j["created"])
+        for old in done[:max(0, len(_JOBS)-100)]: _JOBS.pop(old["id"], None)
+    def work():
+        job.update(state="running", started=time.time())
+        _JOB_LOCAL.job=job
+        try:
+            r=fn(*args, **kw)
+            job.update(state="done" if r.get("ok") else "failed", result=r)
+        except Exception as e:
+            job.update(state="failed", result={"ok":False,"msg":str(e)})
+        finally:
+            _JOB_LOCAL.job=None
+            job["finished"]=time.time()
+    _JOB_POOL.submit(work)
+    return jid
+
+_JOB_LOCAL = threading.local()
+
+def job_progress(**kw):
+    """在任务线程里更新进度（不在任务里调用时忽略）"""
+    job=getattr(_JOB_LOCAL, "job", None)
+    if job is not None: job["progress"]=dict(job["progress"] or {}, **kw)
+
+def job_get(jid:str):
+    with _JOBS_LOCK:
+        j=_JOBS.get(jid)
+        return dict(j) if j else None
+
+# ====== 短时缓存 ======
+_TTL_CACHE = {}
+_TTL_LOCK  = threading.Lock()
+
+def ttl_cached(key, ttl, fn):
+    """key 对应的值在 ttl 秒内复用，过期再调用 fn()"""
+    now=time.monotonic()
+    with _TTL_LOCK:
+        hit=_TTL_CACHE.get(key)
+    if hit and now-hit[0]<ttl: return hit[1]
+    v=fn()
+    with _TTL_LOCK: _TTL_CACHE[key]=(now, v)
+    return v
+
+def ttl_invalidate(*keys):
+    with _TTL_LOCK:
+        if not keys: _TTL_CACHE.clear()
+        for k in keys: _TTL_CACHE.pop(k, None)
+
+def read_default_route():
+    """从 /proc/net/route 读默认路由网卡（metric 最小的那条），不 fork 子进程"""
+    best=None
     try:
-        # 使用 ip route 获取默认路由网卡
-        cmd = "ip route show default | awk '/default/ {print $5}'"
-        return subprocess.check_output(cmd, shell=True).decode().strip()
-    except:
-        return "eth0" # 保底
+        with open("/proc/net/route") as f:
+            next(f)
+            for line in f:
+                p=line.split()
+                if len(p)<7 or p[1]!="00000000" or not int(p[3],16)&1: continue   # RTF_UP
+                if best is None or int(p[6])<best[1]: best=(p[0], int(p[6]))
+    except Exception:
+        pass
+    return best[0] if best else None
+
+# 获取默认网卡的辅助函数
+def get_default_interface():
+    return ttl_cached("route", SVC_TTL, read_default_route) or "eth0" # 保底
 
 default_iface = get_default_interface() # 获取到 ens33
 
@@ -79,43 +353,486 @@ def apply_interface_to_config(config_data):
 
 def get_system_interface():
     """获取系统默认网卡"""
-    try:
-        # 尝试通过 ip route 获取
-        import subprocess
-        cmd = "ip route show default | awk '/default/ {print $5}'"
-        iface = subprocess.check_output(cmd, shell=True).decode().strip()
-        if iface: return iface
-    except:
-        pass
-    return "eth0" # 失败则保底
+    return get_default_interface()
 
-def run(cmd:str, timeout=60):
+def run(cmd:str, timeout=60, input=None):
+    argv=shlex.split(cmd); name=os.path.basename(argv[0]) if argv else "?"
+    t0=time.perf_counter()
     try:
-        p=subprocess.run(shlex.split(cmd), capture_output=True, text=True, timeout=timeout)
-        return p.returncode==0, (p.stdout or ""), (p.stderr or "")
+        p=subprocess.run(argv, capture_output=True, text=True, timeout=timeout, input=input)
+        res=(p.returncode==0, (p.stdout or ""), (p.stderr or ""))
     except Exception as e:
-        return False, "", str(e)
+        res=(False, "", str(e))
+    M_PROC_SECONDS.observe(M_PROC_SECONDS.labels(name), time.perf_counter()-t0)
+    M_PROC_TOTAL.inc(M_PROC_TOTAL.labels(name, "ok" if res[0] else "fail"))
+    return res
+
+# ====== systemd 服务状态（D-Bus 优先，带缓存） ======
+_UNIT_PROPS = ("Description","LoadState","ActiveState","SubState","MainPID","ActiveEnterTimestamp")
+_DBUS_BUS = None
+
+def _unit_name(name:str) -> str:
+    return name if "." in name else f"{name}.service"
+
+def _systemd_manager():
+    global _DBUS_BUS
+    if _DBUS_BUS is None: _DBUS_BUS=dbus.SystemBus()
+    obj=_DBUS_BUS.get_object("org.freedesktop.systemd1", "/org/freedesktop/systemd1")
+    return dbus.Interface(obj, "org.freedesktop.systemd1.Manager")
+
+def _unit_state_dbus(name:str) -> dict:
+    path=_systemd_manager().LoadUnit(_unit_name(name))
+    props=dbus.Interface(_DBUS_BUS.get_object("org.freedesktop.systemd1", path), "org.freedesktop.DBus.Properties")
+    u=props.GetAll("org.freedesktop.systemd1.Unit")
+    st={k:str(u.get(k,"")) for k in _UNIT_PROPS if k in u}
+    try: st["MainPID"]=str(props.Get("org.freedesktop.systemd1.Service","MainPID"))
+    except Exception: st["MainPID"]="0"
+    ts=int(u.get("ActiveEnterTimestamp",0) or 0)
+    st["ActiveEnterTimestamp"]=time.strftime("%a %Y-%m-%d %H:%M:%S %Z", time.localtime(ts/1e6)) if ts else ""
+    return st
+
+def _unit_state_systemctl(name:str) -> dict:
+    ok1, out, _ = run(f"systemctl show {_unit_name(name)} --no-pager -p {','.join(_UNIT_PROPS)}")
+    st={}
+    for line in out.splitlines():
+        k,_,v=line.partition("=")
+        if k in _UNIT_PROPS: st[k]=v
+    return st
+
+def unit_state(name:str=None, fresh=False) -> dict:
+    """服务状态（ActiveState/SubState/MainPID...），SVC_TTL 秒内复用"""
+    name=name or SB_SVC
+    def q():
+        if dbus is not None:
+            try: return _unit_state_dbus(name)
+            except Exception: pass
+        return _unit_state_systemctl(name)
+    if fresh: ttl_invalidate(("unit", name))
+    return ttl_cached(("unit", name), SVC_TTL, q)
+
+def unit_action(action:str, name:str=None, timeout=60):
+    """start/stop/restart 服务，之后让缓存失效。返回 (ok, stdout, stderr)"""
+    name=name or SB_SVC
+    try:
+        if dbus is None: raise RuntimeError("no dbus")
+        mgr=_systemd_manager()
+        getattr(mgr, {"start":"StartUnit","stop":"StopUnit","restart":"RestartUnit"}[action])(_unit_name(name), "replace")
+        res=(True, f"{action} {_unit_name(name)}: queued", "")
+    except Exception:
+        res=run(f"systemctl {action} {name}", timeout=timeout)
+    ttl_invalidate(("unit", name), "route")
+    return res
+
+def unit_status_text(st:dict, name:str=None) -> str:
+    """仿 systemctl status 的摘要文本"""
+    name=_unit_name(name or SB_SVC)
+    since=f" since {st['ActiveEnterTimestamp']}" if st.get("ActiveEnterTimestamp") and st.get("ActiveState")=="active" else ""
+    lines=[f"● {name} - {st.get('Description','')}",
+           f"     Loaded: {st.get('LoadState','unknown')}",
+           f"     Active: {st.get('ActiveState','unknown')} ({st.get('SubState','')}){since}"]
+    if st.get("MainPID") not in (None,"","0"): lines.append(f"   Main PID: {st['MainPID']}")
+    return "\n".join(lines)+"\n"
 
 def http_get(url, timeout=25):
     req=urllib.request.Request(url, headers={"User-Agent":"curl/7.88"})
     with urllib.request.urlopen(req, timeout=timeout) as r: return r.read()
 
-def b64maybe(buf:bytes)->str:
-    try: return base64.b64decode(buf + b"==", validate=False).decode("utf-8","ignore")
-    except Exception: return buf.decode("utf-8","ignore")
+def http_stream(url, timeout=25, chunk=65536):
+    """按块读取响应体，不在内存里拼整段正文"""
+    req=urllib.request.Request(url, headers={"User-Agent":"curl/7.88"})
+    with urllib.request.urlopen(req, timeout=timeout) as r:
+        while True:
+            b=r.read(chunk)
+            if not b: break
+            yield b
+
+def http_fetch(url, cache:dict=None, timeout=25, chunk=65536):
+    """条件请求（If-None-Match / If-Modified-Since），正文边读边算 sha256 并暂存到临时文件。
+    返回 (status, validators, body)；304 时 body 为 None，其余情况 body 为已回到开头的文件对象"""
+    cache=cache or {}
+    headers={"User-Agent":"curl/7.88"}
+    if cache.get("etag"):          headers["If-None-Match"]=cache["etag"]
+    if cache.get("last_modified"): headers["If-Modified-Since"]=cache["last_modified"]
+    req=urllib.request.Request(url, headers=headers)
+    try:
+        r=urllib.request.urlopen(req, timeout=timeout)
+    except urllib.error.HTTPError as e:
+        if e.code==304: return 304, dict(cache), None
+        raise
+    h=hashlib.sha256(); size=0
+    body=tempfile.SpooledTemporaryFile(max_size=1<<20)
+    with r:
+        while True:
+            b=r.read(chunk)
+            if not b: break
+            h.update(b); body.write(b); size+=len(b)
+        v={"etag":r.headers.get("ETag"),"last_modified":r.headers.get("Last-Modified"),
+           "digest":h.hexdigest(),"size":size}
+    body.seek(0)
+    return r.status, v, body
+
+def iter_file(f, chunk=65536):
+    while True:
+        b=f.read(chunk)
+        if not b: break
+        yield b
+
+def iter_lines(chunks):
+    """字节块流 -> 非空行（str）"""
+    rest=b""
+    for c in chunks:
+        lines=(rest+c).split(b"\n"); rest=lines.pop()
+        for l in lines:
+            l=l.strip()
+            if l: yield l.decode("utf-8","ignore")
+    rest=rest.strip()
+    if rest: yield rest.decode("utf-8","ignore")
+
+_B64_JUNK = re.compile(rb"[^A-Za-z0-9+/]")
+_B64_URLSAFE = bytes.maketrans(b"-_", b"+/")
+
+def iter_b64decode(chunks):
+    """分块 base64 解码；换行/空白/填充等非字母表字符直接丢弃，兼容 URL-safe 字母表"""
+    rest=b""
+    for c in chunks:
+        buf=rest+_B64_JUNK.sub(b"", c.translate(_B64_URLSAFE))
+        n=len(buf)//4*4; rest=buf[n:]
+        if n: yield base64.b64decode(buf[:n])
+    if len(rest)>1:
+        yield base64.b64decode(rest+b"="*(-len(rest)%4))
+
+# ====== 网络设置（NAT / DNS 重定向） ======
+# 整套规则一次生成、一次提交：iptables 用自有链 + 一次 iptables-restore --noflush，nft 用独立的 ip sbweb 表（nft -f）。
+# 启动前的 sysctl / resolv.conf / systemd-resolved 状态记在 NET_STATE（KEY=VAL，sb-stop.sh 也能 source），停止时按它恢复。
+# 只动 netfilter 和 /proc/sys，可以在 `ip netns exec` 里单独跑 `sb-web.py net-up --no-dns` 验证
+NET_CHAINS = {"nat":(("PREROUTING","SBWEB_PRE"),("POSTROUTING","SBWEB_POST")), "filter":(("INPUT","SBWEB_IN"),)}
+NET_SYSCTLS = (("IP_FORWARD","net/ipv4/ip_forward"),
+               ("ROUTE_LOCALNET_ALL","net/ipv4/conf/all/route_localnet"),
+               ("ROUTE_LOCALNET_IFACE","net/ipv4/conf/{iface}/route_localnet"))
+NET_RESOLV = "/etc/resolv.conf"
+M_NET_SECONDS = Metric("sbweb_net_setup_seconds", "histogram", "网络规则提交耗时", ("action",), _LAT_BUCKETS)
+
+def read_lan_cidr(iface:str):
+    """/proc/net/route 里 iface 的直连网段（如 192.168.50.0/24）"""
+    try:
+        with open("/proc/net/route") as f:
+            next(f)
+            for line in f:
+                p=line.split()
+                if len(p)<8 or p[0]!=iface or p[1]=="00000000" or p[2]!="00000000": continue
+                dst=socket.inet_ntoa(int(p[1],16).to_bytes(4, sys.byteorder))
+                return f"{dst}/{bin(int(p[7],16)).count('1')}"
+    except Exception:
+        pass
+    return None
+
+def net_backend(backend:str=None) -> str:
+    b=backend or NET_BACKEND
+    if b=="auto": b="iptables" if shutil.which("iptables-restore") or not shutil.which("nft") else "nft"
+    return b
+
+def _sysctl(path:str, val=None):
+    p="/proc/sys/"+path
+    if val is None:
+        try:
+            with open(p) as f: return f.read().strip()
+        except OSError: return None
+    with open(p,"w") as f: f.write(str(val))
+
+def net_state_load() -> dict:
+    st={}
+    try:
+        with open(NET_STATE) as f:
+            for l in f:
+                k,_,v=l.strip().partition("=")
+                if k: st[k]=v
+    except OSError:
+        pass
+    return st
+
+def net_state_save(st:dict):
+    _atomic_write(NET_STATE, "".join(f"{k}={v}\n" for k,v in st.items()))
+
+def _ipt_rules(iface:str, lan:str) -> dict:
+    return {"SBWEB_PRE": [f"-i {iface} -s {lan} -p {p} --dport 53 -j REDIRECT --to-ports 53" for p in ("udp","tcp")],
+            "SBWEB_POST":[f"-o {iface} -j MASQUERADE"],
+            "SBWEB_IN":  [f"-i {iface} -p {p} --dport 53 -j ACCEPT" for p in ("udp","tcp")]}
+
+def _ipt_saved():
+    """读一次 iptables-save：主链里已有的跳转 [(table, base, chain)] 与已存在的自有链 {(table, chain)}"""
+    ok1, out, e = run("iptables-save")
+    if not ok1: raise RuntimeError(e.strip() or "iptables-save 失败")
+    mine={c for hs in NET_CHAINS.values() for _,c in hs}
+    hooks=[]; chains=set(); table=None
+    for l in out.splitlines():
+        if l.startswith("*"): table=l[1:].strip()
+        elif l.startswith(":"):
+            c=l[1:].split(" ",1)[0]
+            if c in mine: chains.add((table, c))
+        elif l.startswith("-A "):
+            p=l.split()
+            if len(p)==4 and p[2]=="-j" and p[3] in mine: hooks.append((table, p[1], p[3]))
+    return hooks, chains
+
+def net_render_iptables(iface:str, lan:str, hooks=()) -> str:
+    """iptables-restore --noflush 输入：声明（即清空）自有链并写规则，主链里缺的跳转补上"""
+    rules=_ipt_rules(iface, lan); out=[]
+    for table, hs in NET_CHAINS.items():
+        out.append("*"+table)
+        out+=[f":{c} - [0:0]" for _,c in hs]
+        for _,c in hs: out+=[f"-A {c} {r}" for r in rules[c]]
+        for base,c in hs:   # INPUT 插到最前，避免被已有的 DROP 挡住（与旧脚本的 -I 一致）
+            if (table, base, c) not in hooks: out.append(f"{'-I' if base=='INPUT' else '-A'} {base} -j {c}")
+        out.append("COMMIT")
+    return "\n".join(out)+"\n"
+
+def net_render_iptables_down(hooks, chains) -> str:
+    out=[]
+    for table, hs in NET_CHAINS.items():
+        body=[f"-D {b} -j {c}" for t,b,c in hooks if t==table]
+        for _,c in hs:
+            if (table, c) in chains: body+=[f"-F {c}", f"-X {c}"]
+        if body: out+=["*"+table]+body+["COMMIT"]
+    return "\n".join(out)+"\n" if out else ""
+
+def net_render_nft(iface:str, lan:str) -> str:
+    """先建后删再建，保证 nft -f 幂等；整个文件是一个事务"""
+    return (f'table ip sbweb\ndelete table ip sbweb\ntable ip sbweb {{\n'
+            f'\tchain pre {{ type nat hook prerouting priority dstnat; iifname "{iface}" ip saddr {lan} meta l4proto {{ udp, tcp }} th dport 53 redirect to :53; }}\n'
+            f'\tchain post {{ type nat hook postrouting priority srcnat; oifname "{iface}" masquerade; }}\n'
+            f'\tchain input {{ type filter hook input priority filter; iifname "{iface}" meta l4proto {{ udp, tcp }} th dport 53 accept; }}\n'
+            f'}}\n')
+
+NET_NFT_DOWN = "table ip sbweb\ndelete table ip sbweb\n"
+
+def net_render(iface:str=None, lan:str=None, backend:str=None) -> (str, str, str, str):
+    """返回 (backend, iface, lan, 规则文本)；iptables 的跳转按“尚未存在”渲染"""
+    iface=iface or get_default_interface()
+    lan=lan or NET_LAN or read_lan_cidr(iface) or "192.168.50.0/24"
+    b=net_backend(backend)
+    return b, iface, lan, (net_render_nft(iface, lan) if b=="nft" else net_render_iptables(iface, lan))
+
+def _net_commit(backend:str, text:str):
+    if not text: return True, "", ""
+    return run("nft -f -" if backend=="nft" else "iptables-restore --noflush", input=text)
+
+def net_up(iface:str=None, lan:str=None, backend:str=None, dns=True) -> (bool, str, str):
+    """sysctl + NAT/DNS 规则（一次事务）+ 本机 DNS 指向 127.0.0.1；返回 (ok, stdout, stderr)"""
+    t0=time.perf_counter()
+    b, iface, lan, text = net_render(iface, lan, backend)
+    prev=net_state_load()
+    st={"IFACE_NAME":iface, "LAN_CIDR":lan, "NET_BACKEND":b}
+    for k,path in NET_SYSCTLS:      # 重复 net-up 时保留最初的值
+        st[k]=prev.get(k) if prev.get("IFACE_NAME")==iface and k in prev else (_sysctl(path.format(iface=iface)) or "0")
+    st["DNS_MANAGED"]="1" if dns else "0"
+    if dns: st["RESOLVED_ACTIVE"]=prev.get("RESOLVED_ACTIVE") or ("1" if unit_state("systemd-resolved", fresh=True).get("ActiveState")=="active" else "0")
+    net_state_save(st)
+    out=[f"net-up: IFACE={iface}, LAN_CIDR={lan}, backend={b}"]
+    try:
+        for k,path in NET_SYSCTLS: _sysctl(path.format(iface=iface), 1)
+    except OSError as e:
+        return False, "\n".join(out), f"sysctl 失败: {e}"
+    if b=="iptables":
+        try: hooks,_=_ipt_saved()
+        except RuntimeError as e: return False, "\n".join(out), str(e)
+        text=net_render_iptables(iface, lan, set(hooks))
+    ok1, o, e = _net_commit(b, text)
+    if not ok1: return False, "\n".join(out+[o]), e or "规则提交失败"
+    out.append(f"net-up: {text.count(chr(10))} 行规则已提交")
+    if dns:
+        if not os.path.exists(NET_RESOLV+".sb.bak"):
+            try: shutil.copyfile(NET_RESOLV, NET_RESOLV+".sb.bak")
+            except OSError: pass
+        if st["RESOLVED_ACTIVE"]=="1": run("systemctl disable --now systemd-resolved")   # 避免占 53 / 改 resolv.conf
+        with open(NET_RESOLV,"w") as f: f.write("nameserver 127.0.0.1\n")
+    if NET_PERSIST and shutil.which("netfilter-persistent"): run("netfilter-persistent save")
+    M_NET_SECONDS.observe(M_NET_SECONDS.labels("up"), time.perf_counter()-t0)
+    return True, "\n".join(out), ""
+
+def net_down(dns=True) -> (bool, str, str):
+    """按 NET_STATE 撤掉规则、恢复 sysctl / resolv.conf / systemd-resolved"""
+    t0=time.perf_counter()
+    st=net_state_load()
+    iface=st.get("IFACE_NAME") or get_default_interface()
+    b=st.get("NET_BACKEND") or net_backend()
+    out=[f"net-down: IFACE={iface}, backend={b}"]; errs=[]
+    if b=="iptables":
+        try:
+            hooks, chains = _ipt_saved()
+            text=net_render_iptables_down(hooks, chains)
+        except RuntimeError as e:
+            text=""; errs.append(str(e))
+    else:
+        text=NET_NFT_DOWN
+    ok1, o, e = _net_commit(b, text)
+    if not ok1: errs.append(e or "规则撤销失败")
+    if st:
+        for k,path in NET_SYSCTLS:
+            p=path.format(iface=iface)
+            if k in st and os.path.exists("/proc/sys/"+p):
+                try: _sysctl(p, st[k])
+                except OSError as e: errs.append(f"sysctl {p}: {e}")
+    if dns and st.get("DNS_MANAGED", "1")=="1":
+        try:
+            if os.path.exists(NET_RESOLV+".sb.bak"): os.replace(NET_RESOLV+".sb.bak", NET_RESOLV)
+            else:
+                with open(NET_RESOLV,"w") as f: f.write("nameserver 192.168.50.1\n")
+        except OSError as e: errs.append(f"resolv.conf: {e}")
+        if st.get("RESOLVED_ACTIVE")=="1": run("systemctl enable --now systemd-resolved")
+    if NET_PERSIST and shutil.which("netfilter-persistent"): run("netfilter-persistent save")
+    try: os.unlink(NET_STATE)
+    except OSError: pass
+    M_NET_SECONDS.observe(M_NET_SECONDS.labels("down"), time.perf_counter()-t0)
+    out.append("net-down: done.")
+    return not errs, "\n".join(out), "\n".join(errs)
+
+def net_cli(argv:list) -> int:
+    """sb-web.py net-up|net-down|net-render [--iface X] [--lan CIDR] [--backend iptables|nft] [--no-dns]"""
+    ap=argparse.ArgumentParser(prog="sb-web.py")
+    ap.add_argument("action", choices=("net-up","net-down","net-render"))
+    ap.add_argument("--iface"); ap.add_argument("--lan")
+    ap.add_argument("--backend", choices=("auto","iptables","nft"))
+    ap.add_argument("--no-dns", action="store_true", help="不改 resolv.conf / systemd-resolved（如在 netns 里测试）")
+    a=ap.parse_args(argv)
+    if a.action=="net-render":
+        print(net_render(a.iface, a.lan, a.backend)[3], end=""); return 0
+    ok1, out, e = net_up(a.iface, a.lan, a.backend, dns=not a.no_dns) if a.action=="net-up" else net_down(dns=not a.no_dns)
+    if out: print(out)
+    if e: print(e, file=sys.stderr)
+    return 0 if ok1 else 1
+
+# ====== 节点/状态存储（进程内缓存） ======
+# 文件按 (路径, mtime, size) 判断是否被外部修改，未变化时直接用内存里的副本；
+# 写入为紧凑 JSON，先写临时文件并 fsync 再 rename；状态文件的多次写入合并成一次落盘
+STATE_FLUSH_DELAY = 0.3
+
+def _file_sig(path):
+    try: st=os.stat(path); return (path, st.st_mtime_ns, st.st_size)
+    except OSError: return (path, None, None)
+
+def _atomic_write(path, raw:str):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp=path+".tmp"
+    with open(tmp,"w") as f:
+        f.write(raw); f.flush(); os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+def _dumps(obj) -> str:
+    return json.dumps(obj, ensure_ascii=False, separators=(",",":"))
+
+class NodeStore:
+    """节点列表 + 按 tag / server / type 的索引"""
+    def __init__(self):
+        self.lock=threading.Lock()
+        self.sig=None; self.version=0
+        self.nodes=[]; self.by_tag={}; self.by_server={}; self.by_type={}
+
+    def _index(self, nodes:list, sig):
+        by_tag, by_server, by_type = {}, {}, {}
+        for i,n in enumerate(nodes):
+            by_tag.setdefault(n.get("tag"), i)
+            by_server.setdefault(n.get("server"), []).append(i)
+            by_type.setdefault(n.get("type"), []).append(i)
+        self.nodes, self.by_tag, self.by_server, self.by_type = nodes, by_tag, by_server, by_type
+        self.sig=sig; self.version+=1
+
+    def get(self) -> list:
+        sig=_file_sig(NODES_FILE)
+        if sig!=self.sig:
+            with self.lock:
+                if sig!=self.sig:
+                    try: nodes=json.load(open(NODES_FILE)).get("nodes",[])
+                    except Exception: nodes=[]
+                    self._index(nodes, sig)
+        return self.nodes
+
+    def save(self, nodes:list):
+        with self.lock:
+            _atomic_write(NODES_FILE, _dumps({"nodes":nodes}))
+            self._index(nodes, _file_sig(NODES_FILE))
+
+class StateStore:
+    """状态字典；state_save 后延迟 STATE_FLUSH_DELAY 秒落盘，期间的多次修改合并写一次"""
+    def __init__(self):
+        self.lock=threading.RLock()
+        self.sig=None; self.data={}; self.dirty=False; self.timer=None
+
+    def get(self) -> dict:
+        with self.lock:
+            if not self.dirty:
+                sig=_file_sig(STATE_FILE)
+                if sig!=self.sig:
+                    try: self.data=json.load(open(STATE_FILE))
+                    except Exception: self.data={}
+                    self.sig=sig
+            return json.loads(_dumps(self.data))    # 调用方会就地修改，给一份副本
+
+    def put(self, obj:dict):
+        with self.lock:
+            self.data=json.loads(_dumps(obj)); self.dirty=True
+            if self.timer is None:
+                self.timer=threading.Timer(STATE_FLUSH_DELAY, self.flush)
+                self.timer.daemon=True; self.timer.start()
+
+    def flush(self):
+        with self.lock:
+            self.timer=None
+            if not self.dirty: return
+            _atomic_write(STATE_FILE, _dumps(self.data))
+            self.sig=_file_sig(STATE_FILE); self.dirty=False
+
+_NODE_STORE  = NodeStore()
+_STATE_STORE = StateStore()
+atexit.register(_STATE_STORE.flush)
 
 def state_load():
-    try: return json.load(open(STATE_FILE))
-    except Exception: return {}
+    return _STATE_STORE.get()
 def state_save(obj:dict):
-    os.makedirs(os.path.dirname(STATE_FILE), exist_ok=True)
-    tmp=STATE_FILE+".tmp"; open(tmp,"w").write(json.dumps(obj,ensure_ascii=False,indent=2)); os.replace(tmp,STATE_FILE)
+    _STATE_STORE.put(obj)
+def state_update(**kw):
+    """只改给出的键（值为 None 时删除），其余取最新，不会覆盖别处刚写入的字段（如 cfg_checks）"""
+    with _STATE_STORE.lock:
+        st=_STATE_STORE.get()
+        for k,v in kw.items():
+            if v is None: st.pop(k, None)
+            else: st[k]=v
+        _STATE_STORE.put(st)
+def state_flush():
+    _STATE_STORE.flush()
 def nodes_load():
-    try: return json.load(open(NODES_FILE)).get("nodes",[])
-    except Exception: return []
+    """返回缓存中的节点列表本身，调用方不要修改（需要改时先 dict(n) 复制）"""
+    return _NODE_STORE.get()
 def nodes_save(nodes:list):
-    os.makedirs(os.path.dirname(NODES_FILE), exist_ok=True)
-    tmp=NODES_FILE+".tmp"; open(tmp,"w").write(json.dumps({"nodes":nodes},ensure_ascii=False,indent=2)); os.replace(tmp,NODES_FILE)
+    _NODE_STORE.save(nodes)
+def node_by_tag(tag:str):
+    """按 tag 查节点，返回 (idx, node)；没有则 (None, None)"""
+    nodes=_NODE_STORE.get()
+    i=_NODE_STORE.by_tag.get(tag)
+    return (i, nodes[i]) if i is not None else (None, None)
+def nodes_find(server:str=None, typ:str=None) -> list:
+    """按 server / type 查节点下标"""
+    _NODE_STORE.get()
+    sets=[]
+    if server is not None: sets.append(_NODE_STORE.by_server.get(server, []))
+    if typ is not None:    sets.append(_NODE_STORE.by_type.get(typ, []))
+    if not sets: return list(range(len(_NODE_STORE.nodes)))
+    return sorted(set(sets[0]).intersection(*sets[1:]))
+
+_CFG_CACHE = {"sig":None, "cfg":None}
+def cfg_load() -> dict:
+    """只读的 sing-box 配置（按 mtime 缓存）；要修改请用 json.load 重新读"""
+    sig=_file_sig(SB_CFG)
+    if sig!=_CFG_CACHE["sig"]:
+        cfg=json.load(open(SB_CFG))
+        _CFG_CACHE.update(sig=sig, cfg=cfg)
+    return _CFG_CACHE["cfg"]
+
+def cfg_editable() -> dict:
+    """cfg_load 的浅拷贝，可以改顶层键、替换 outbounds 列表；experimental / route 会被就地修改，单独复制"""
+    cfg=dict(cfg_load())
+    for k in ("experimental","route"):
+        if k in cfg: cfg[k]=json.loads(json.dumps(cfg[k]))
+    return cfg
 
 def get_multiplex_config():
     """返回多路复用配置"""
@@ -129,13 +846,91 @@ def get_multiplex_config():
         "max_streams": MULTIPLEX_MAX_STREAMS
     }
 
+# ====== 解析结果缓存 ======
+# 键 = 摘要(注入设置 + 原始链接/节点)，值 = 紧凑 JSON 字符串（比 dict 省内存，取出即是新副本）。
+# 多路复用/resolver/网卡等设置变了，摘要前缀随之改变，旧条目自然失效；落盘文件也按设置签名整体作废
+PARSE_CACHE_REV = 1     # 解析逻辑有改动时 +1
+
+def parse_settings_sig() -> str:
+    cfg=[PARSE_CACHE_REV, INJECT_RESOLVER_TAG, INJECT_IFACE, get_multiplex_config()]
+    return hashlib.sha1(_dumps(cfg).encode()).hexdigest()[:16]
+
+class ParseCache:
+    """有界 LRU：digest -> outbound JSON"""
+    def __init__(self, size:int):
+        self.size=size; self.lock=threading.Lock()
+        self.data=OrderedDict(); self.sig=None; self.loaded=False; self.dirty=False
+        self.hits=0; self.misses=0
+
+    def _load(self):
+        self.loaded=True; self.sig=parse_settings_sig()
+        if not PARSE_CACHE_PERSIST: return
+        try: js=json.load(open(PARSE_CACHE_FILE))
+        except Exception: return
+        if js.get("sig")==self.sig:
+            self.data.update(list(js.get("items",{}).items())[-self.size:])
+
+    def key(self, raw:str) -> str:
+        if not self.loaded:
+            with self.lock:
+                if not self.loaded: self._load()
+        return hashlib.blake2b((self.sig+"\n"+raw).encode("utf-8","ignore"), digest_size=16).hexdigest()
+
+    def get(self, k:str):
+        with self.lock:
+            v=self.data.get(k)
+            if v is None: self.misses+=1; return None
+            self.data.move_to_end(k); self.hits+=1
+        return json.loads(v)
+
+    def put(self, k:str, ob:dict):
+        v=_dumps(ob)
+        with self.lock:
+            self.data[k]=v; self.data.move_to_end(k); self.dirty=True
+            while len(self.data)>self.size: self.data.popitem(last=False)
+
+    def save(self):
+        if not (PARSE_CACHE_PERSIST and self.dirty): return
+        with self.lock:
+            raw=_dumps({"sig":self.sig,"items":self.data}); self.dirty=False
+        try: _atomic_write(PARSE_CACHE_FILE, raw)
+        except OSError: pass
+
+    def stats(self) -> dict:
+        return {"size":len(self.data),"hits":self.hits,"misses":self.misses}
+
+_PARSE_CACHE = ParseCache(PARSE_CACHE_SIZE)
+atexit.register(_PARSE_CACHE.save)
+
+def parse_cached(raw:str, fn):
+    """raw 相同（且注入设置未变）时直接返回上次的结果副本；解析失败（None）不缓存"""
+    if PARSE_CACHE_SIZE<=0: return fn()
+    k=_PARSE_CACHE.key(raw)
+    ob=_PARSE_CACHE.get(k)
+    if ob is None:
+        ob=fn()
+        if ob is not None: _PARSE_CACHE.put(k, ob)
+    return ob
+
 # ====== 解析订阅（v2rayN + Clash YAML） ======
-def normalize_tag(t, used:set):
-    t=re.sub(r"[^A-Za-z0-9_.:-]+","_", t or "node").strip("_")[:48]
+_TAG_JUNK = re.compile(r"[^A-Za-z0-9_.:-]+")
+
+@functools.lru_cache(maxsize=8192)
+def _tag_base(t:str) -> str:
+    return _TAG_JUNK.sub("_", t).strip("_")[:48] or "node"
+
+class TagSet(set):
+    """已用 tag 集合 + 每个基础名下一个可用序号，重名很多时不用每次从 -2 开始试"""
+    def __init__(self, *a):
+        super().__init__(*a); self.next={}
+
+def normalize_tag(t, used:TagSet):
+    """used 必须是 TagSet：普通 set 没有序号表，重名多时会退化成平方复杂度"""
+    t=_tag_base(t or "node")
     if t in used:
-        i=2
+        i=used.next.get(t, 2)
         while f"{t}-{i}" in used: i+=1
-        t=f"{t}-{i}"
+        used.next[t]=i+1; t=f"{t}-{i}"
     used.add(t); return t
 
 def inject(ob:dict):
@@ -322,155 +1117,622 @@ def parse_trojan(line: str):
             ob["tls"]["alpn"]=["h2","http/1.1"]
     return inject(ob)
 
+# ====== Clash YAML：只解析 proxies 段 ======
+# 有 libyaml 时用 C 实现的 CSafeLoader；按事件流扫描顶层键，只为 proxies 段建树，
+# 其余（rules / proxy-groups，往往上万行）直接跳过事件，找到后不再往下读
+_YAML_LOADER = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+YAML_PROXY_KEYS = ("proxies", "Proxy", "proxy")
+
+class _YamlFallback(Exception):
+    """proxies 段引用了被跳过部分里的锚点，只能整篇解析"""
+
+def _yaml_skip(loader, skipped:set):
+    depth=0
+    while True:
+        ev=loader.get_event()
+        if getattr(ev, "anchor", None) and not isinstance(ev, yaml.AliasEvent): skipped.add(ev.anchor)
+        if isinstance(ev, (yaml.SequenceStartEvent, yaml.MappingStartEvent)): depth+=1
+        elif isinstance(ev, (yaml.SequenceEndEvent, yaml.MappingEndEvent)): depth-=1
+        if depth<=0: return
+
+def _yaml_compose(loader, anchors:dict):
+    """事件 -> yaml.Node（与 Composer 的规则一致）"""
+    ev=loader.get_event()
+    if isinstance(ev, yaml.AliasEvent):
+        if ev.anchor not in anchors: raise _YamlFallback(ev.anchor)
+        return anchors[ev.anchor]
+    tag=ev.tag
+    if isinstance(ev, yaml.ScalarEvent):
+        if tag is None or tag=="!": tag=loader.resolve(yaml.ScalarNode, ev.value, ev.implicit)
+        node=yaml.ScalarNode(tag, ev.value, ev.start_mark, ev.end_mark, style=ev.style)
+        if ev.anchor: anchors[ev.anchor]=node
+        return node
+    seq=isinstance(ev, yaml.SequenceStartEvent)
+    cls=yaml.SequenceNode if seq else yaml.MappingNode
+    if tag is None or tag=="!": tag=loader.resolve(cls, None, ev.implicit)
+    node=cls(tag, [], ev.start_mark, None, flow_style=ev.flow_style)
+    if ev.anchor: anchors[ev.anchor]=node
+    end=yaml.SequenceEndEvent if seq else yaml.MappingEndEvent
+    while not loader.check_event(end):
+        if seq: node.value.append(_yaml_compose(loader, anchors))
+        else:   node.value.append((_yaml_compose(loader, anchors), _yaml_compose(loader, anchors)))
+    node.end_mark=loader.get_event().end_mark
+    return node
+
+def clash_proxies(text) -> list:
+    """返回 Clash 文档里的 proxies 列表；文档不是映射或没有 proxies 时返回 []"""
+    loader=_YAML_LOADER(text)
+    try:
+        loader.get_event(); loader.get_event()          # StreamStart, DocumentStart
+        if not loader.check_event(yaml.MappingStartEvent): return []
+        loader.get_event()
+        anchors, skipped = {}, set()
+        while not loader.check_event(yaml.MappingEndEvent):
+            key=loader.peek_event()
+            name=key.value if isinstance(key, yaml.ScalarEvent) else None
+            _yaml_skip(loader, skipped)
+            if name not in YAML_PROXY_KEYS:
+                _yaml_skip(loader, skipped); continue
+            try: node=_yaml_compose(loader, anchors)
+            except _YamlFallback as e:
+                if str(e) in skipped: break
+                raise
+            data=loader.construct_document(node)
+            if data: return data if isinstance(data, list) else []
+        else:
+            return []
+    finally:
+        loader.dispose()
+    # 罕见：锚点定义在被跳过的段里，退回整篇解析
+    data=yaml.load(text, Loader=_YAML_LOADER)
+    if not isinstance(data, dict): return []
+    return next((data[k] for k in YAML_PROXY_KEYS if data.get(k)), None) or []
+
 def parse_clash_yaml(text: str):
-    try: data=yaml.safe_load(text)
+    """Clash YAML -> outbound 列表；tag 保留原始名字，去重与统一命名只在 dedup_nodes 里做一次"""
+    try:
+        with timed(M_YAML_SECONDS, M_YAML_SECONDS.labels()): proxies=clash_proxies(text)
     except Exception: return []
-    proxies=data.get("proxies") or data.get("Proxy") or data.get("proxy") or []
-    nodes, used = [], set()
+    if not isinstance(proxies, list): return []
+    nodes=[]
     for p in proxies:
-        try:
-            typ=(p.get("type") or "").lower()
-            name=normalize_tag(p.get("name") or f"{p.get('server')}:{p.get('port')}", used)
-            srv=p.get("server"); prt=int(p.get("port") or 443)
-            sni=p.get("sni") or p.get("servername") or srv
-            alpn=p.get("alpn") or ["http/1.1"]
-            fp=p.get("client-fingerprint") or p.get("fingerprint") or "chrome"
-            insecure=bool(p.get("skip-cert-verify"))
-
-            if typ=="vmess":
-                ws=p.get("ws-opts") or {}
-                path=(ws.get("path") or "/"); headers=ws.get("headers") or {}
-                host=headers.get("Host") or headers.get("host") or p.get("servername") or srv
-                if not path.startswith("/"): path="/"+path
-                tls_enabled = bool(p.get("tls")) or bool(ws)
-                ob={"type":"vmess","tag":name,"server":srv,"server_port":prt,"uuid":p.get("uuid"),
-                    "security":"auto",
-                    "tls":{"enabled":tls_enabled,"server_name":sni,"insecure":True,"alpn":alpn if isinstance(alpn,list) else [alpn],
-                           "utls":{"enabled":True,"fingerprint":fp}},
-                    "transport":{"type":"ws" if ws else "tcp","path":path,
-                                 "headers":{"Host":host} if host and ws else None,"max_early_data":0}}
+        if not isinstance(p, dict): continue
+        name=p.get("name") or f"{p.get('server')}:{p.get('port')}"
+        try: raw=json.dumps(p, sort_keys=True, ensure_ascii=False, default=str)
+        except Exception: continue
+        typ=str(p.get("type") or "").lower()
+        with timed(M_PARSE_SECONDS, M_PARSE_SECONDS.labels(_PROTO_NAME.get(typ, typ) if typ in PARSERS else "other")):
+            ob=parse_cached("clash:"+raw, lambda: parse_clash_proxy(p))
+        if ob is None: continue
+        ob["tag"]=name
+        nodes.append(ob)
+    return nodes
+
+def parse_clash_proxy(p:dict):
+    """单个 Clash 节点 -> outbound（tag 为原始名字，由调用方统一命名）；不支持的返回 None"""
+    try:
+        typ=(p.get("type") or "").lower()
+        name=p.get("name") or f"{p.get('server')}:{p.get('port')}"
+        srv=p.get("server"); prt=int(p.get("port") or 443)
+        sni=p.get("sni") or p.get("servername") or srv
+        alpn=p.get("alpn") or ["http/1.1"]
+        fp=p.get("client-fingerprint") or p.get("fingerprint") or "chrome"
+        insecure=bool(p.get("skip-cert-verify"))
+
+        if typ=="vmess":
+            ws=p.get("ws-opts") or {}
+            path=(ws.get("path") or "/"); headers=ws.get("headers") or {}
+            host=headers.get("Host") or headers.get("host") or p.get("servername") or srv
+            if not path.startswith("/"): path="/"+path
+            tls_enabled = bool(p.get("tls")) or bool(ws)
+            ob={"type":"vmess","tag":name,"server":srv,"server_port":prt,"uuid":p.get("uuid"),
+                "security":"auto",
+                "tls":{"enabled":tls_enabled,"server_name":sni,"insecure":True,"alpn":alpn if isinstance(alpn,list) else [alpn],
+                       "utls":{"enabled":True,"fingerprint":fp}},
+                "transport":{"type":"ws" if ws else "tcp","path":path,
+                             "headers":{"Host":host} if host and ws else None,"max_early_data":0}}
+            
+            # 添加多路复用
+            mux = get_multiplex_config()
+            if mux:
+                ob["multiplex"] = mux
                 
-                # 添加多路复用
-                mux = get_multiplex_config()
-                if mux:
-                    ob["multiplex"] = mux
-                    
-            elif typ=="vless":
+        elif typ=="vless":
+            ws=p.get("ws-opts") or {}
+            path=(ws.get("path") or "/"); headers=ws.get("headers") or {}
+            host=headers.get("Host") or headers.get("host") or p.get("servername") or srv
+            if not path.startswith("/"): path="/"+path
+            ob={"type":"vless","tag":name,"server":srv,"server_port":prt,"uuid":p.get("uuid"),"flow":p.get("flow"),
+                "tls":{"enabled":True,"server_name":sni,"insecure":insecure,"alpn":alpn if isinstance(alpn,list) else [alpn],
+                       "utls":{"enabled":True,"fingerprint":fp}},
+                "transport":{"type":"ws" if ws else "tcp","path":path,
+                             "headers":{"Host":host} if host and ws else None,"max_early_data":0}}
+        elif typ=="trojan":
+            ob={"type":"trojan","tag":name,"server":srv,"server_port":prt,"password":p.get("password"),
+                "tls":{"enabled":True,"server_name":sni,"insecure":insecure,"alpn":alpn if isinstance(alpn,list) else [alpn],
+                       "utls":{"enabled":True,"fingerprint":fp}}}
+            
+            # 添加多路复用
+            mux = get_multiplex_config()
+            if mux:
+                ob["multiplex"] = mux
+            
+            if p.get("network")=="ws" or p.get("ws-opts"):
                 ws=p.get("ws-opts") or {}
                 path=(ws.get("path") or "/"); headers=ws.get("headers") or {}
-                host=headers.get("Host") or headers.get("host") or p.get("servername") or srv
+                host=headers.get("Host") or headers.get("host") or sni or srv
                 if not path.startswith("/"): path="/"+path
-                ob={"type":"vless","tag":name,"server":srv,"server_port":prt,"uuid":p.get("uuid"),"flow":p.get("flow"),
-                    "tls":{"enabled":True,"server_name":sni,"insecure":insecure,"alpn":alpn if isinstance(alpn,list) else [alpn],
-                           "utls":{"enabled":True,"fingerprint":fp}},
-                    "transport":{"type":"ws" if ws else "tcp","path":path,
-                                 "headers":{"Host":host} if host and ws else None,"max_early_data":0}}
-            elif typ=="trojan":
-                ob={"type":"trojan","tag":name,"server":srv,"server_port":prt,"password":p.get("password"),
-                    "tls":{"enabled":True,"server_name":sni,"insecure":insecure,"alpn":alpn if isinstance(alpn,list) else [alpn],
-                           "utls":{"enabled":True,"fingerprint":fp}}}
-                
-                # 添加多路复用
-                mux = get_multiplex_config()
-                if mux:
-                    ob["multiplex"] = mux
-                
-                if p.get("network")=="ws" or p.get("ws-opts"):
-                    ws=p.get("ws-opts") or {}
-                    path=(ws.get("path") or "/"); headers=ws.get("headers") or {}
-                    host=headers.get("Host") or headers.get("host") or sni or srv
-                    if not path.startswith("/"): path="/"+path
-                    ob["transport"]={"type":"ws","path":path}
-                    if host: ob["transport"]["headers"]={"Host":host}
-                if p.get("network")=="h2" or p.get("h2-opts"):
-                    h2=p.get("h2-opts") or {}
-                    path=(h2.get("path") or "/")
-                    if not path.startswith("/"): path="/"+path
-                    ob["transport"]={"type":"h2","path":path}
-                    if "h2" not in ob["tls"]["alpn"]: ob["tls"]["alpn"]=["h2","http/1.1"]
-            elif typ == "hysteria2":
-                pwd = p.get("password") or ""
-                sni = p.get("sni") or p.get("servername") or srv
-                alpn = p.get("alpn") or ["h3"]
-                if isinstance(alpn, str): alpn=[alpn]
-                ob = {
-                    "type":"hysteria2","tag":name,
-                    "server":srv,"server_port":prt,"password":pwd,
-                    "tls":{"enabled":True,"server_name":sni,"insecure":insecure,"alpn":alpn},
-                    "domain_strategy":"ipv4_only"
-                }
-                nodes.append(inject(ob)); continue
-
-            elif typ == "tuic":
-                uuid = p.get("uuid") or p.get("id") or ""
-                pwd  = p.get("password") or ""
-                sni = p.get("sni") or p.get("servername") or srv
-                alpn = p.get("alpn") or ["h3"]
-                if isinstance(alpn, str): alpn=[alpn]
-                cc = p.get("congestion_control") or "bbr"
-                ob = {
-                    "type":"tuic","tag":name,
-                    "server":srv,"server_port":prt,"uuid":uuid,"password":pwd,
-                    "congestion_control": cc,
-                    "tls":{"enabled":True,"server_name":sni,"insecure":True,"alpn":alpn},
-                    "domain_strategy":"ipv4_only"
-                }
-                nodes.append(inject(ob)); continue
-            else:
-                continue
-            nodes.append(inject(ob))
-        except Exception:
+                ob["transport"]={"type":"ws","path":path}
+                if host: ob["transport"]["headers"]={"Host":host}
+            if p.get("network")=="h2" or p.get("h2-opts"):
+                h2=p.get("h2-opts") or {}
+                path=(h2.get("path") or "/")
+                if not path.startswith("/"): path="/"+path
+                ob["transport"]={"type":"h2","path":path}
+                if "h2" not in ob["tls"]["alpn"]: ob["tls"]["alpn"]=["h2","http/1.1"]
+        elif typ == "hysteria2":
+            pwd = p.get("password") or ""
+            sni = p.get("sni") or p.get("servername") or srv
+            alpn = p.get("alpn") or ["h3"]
+            if isinstance(alpn, str): alpn=[alpn]
+            ob = {
+                "type":"hysteria2","tag":name,
+                "server":srv,"server_port":prt,"password":pwd,
+                "tls":{"enabled":True,"server_name":sni,"insecure":insecure,"alpn":alpn},
+                "domain_strategy":"ipv4_only"
+            }
+            return inject(ob)
+
+        elif typ == "tuic":
+            uuid = p.get("uuid") or p.get("id") or ""
+            pwd  = p.get("password") or ""
+            sni = p.get("sni") or p.get("servername") or srv
+            alpn = p.get("alpn") or ["h3"]
+            if isinstance(alpn, str): alpn=[alpn]
+            cc = p.get("congestion_control") or "bbr"
+            ob = {
+                "type":"tuic","tag":name,
+                "server":srv,"server_port":prt,"uuid":uuid,"password":pwd,
+                "congestion_control": cc,
+                "tls":{"enabled":True,"server_name":sni,"insecure":True,"alpn":alpn},
+                "domain_strategy":"ipv4_only"
+            }
+            return inject(ob)
+        else:
+            return None
+        return inject(ob)
+    except Exception:
+        return None
+
+# 协议 -> 解析函数
+PARSERS = {
+    "vmess":     parse_vmess,
+    "vless":     parse_vless,
+    "trojan":    parse_trojan,
+    "hysteria2": parse_hysteria2,
+    "hy2":       parse_hysteria2,
+    "tuic":      parse_tuic,
+}
+_PROTO_NAME = {"hy2":"hysteria2"}
+_LINK_RE  = re.compile(rb"(?:" + rb"|".join(re.escape(k.encode()) for k in PARSERS) + rb")://")
+_B64_BODY = re.compile(rb"[A-Za-z0-9+/=_\-\s]*")
+SNIFF_BYTES = 4096
+
+def parse_line(line:str):
+    scheme,sep,_=line.partition("://")
+    fn=PARSERS.get(scheme.lower()) if sep else None
+    if not fn: return None
+    def parse():
+        try: return fn(line)
+        except Exception: return None
+    with timed(M_PARSE_SECONDS, M_PARSE_SECONDS.labels(_PROTO_NAME.get(scheme.lower(), scheme.lower()))):
+        return parse_cached(line, parse)
+
+def _iter_outbounds(chunks, decoded=False):
+    """订阅正文（字节块流）-> 逐个产出 outbound；格式只在开头判断一次"""
+    chunks=iter(chunks); head=b""
+    for c in chunks:
+        head+=c
+        if len(head)>=SNIFF_BYTES: break
+    if not head.strip(): return
+    stream=itertools.chain([head], chunks)
+    # 明文分享链接
+    if _LINK_RE.search(head):
+        for l in iter_lines(stream):
+            ob=parse_line(l)
+            if ob: yield ob
+        return
+    # base64（整体编码的分享链接或 YAML）
+    if not decoded and _B64_BODY.fullmatch(head):
+        yield from _iter_outbounds(iter_b64decode(stream), decoded=True)
+        return
+    # Clash YAML（需要整篇文档）
+    yield from parse_clash_yaml(b"".join(stream).decode("utf-8","ignore"))
+
+def dedup_nodes(obs, used:set=None, stats:dict=None):
+    """去重 + 统一命名：地址/端口/凭据相同（node_key 一致）的只留第一个，名字不同也算重复；
+    tag 按出现顺序去重。stats 里累计 dupes（丢弃的重复节点数）"""
+    seen=set(); used=TagSet() if used is None else used
+    for ob in obs:
+        k=node_key(ob)
+        if k in seen:
+            if stats is not None: stats["dupes"]=stats.get("dupes",0)+1
             continue
-    return nodes
+        seen.add(k)
+        ob["_name"]=ob.get("tag") or ""     # 原始名字，合并多个订阅时据此重新命名
+        ob["tag"]=normalize_tag(ob.get("tag"), used)
+        yield ob
+
+def iter_subscription(chunks, stats:dict=None):
+    """订阅正文 -> 去重、命名后的 outbound（各种格式同一出口）"""
+    return dedup_nodes(_iter_outbounds(chunks), stats=stats)
 
 def parse_subscription(url:str):
-    raw=http_get(url); text=raw.decode("utf-8","ignore")
-    # 明文
-    if any(s in text for s in ("vmess://","vless://","trojan://","hysteria2://","hy2://","tuic://")):
-        lines = [l.strip() for l in text.splitlines() if l.strip()]
-        out=[]
-        for l in lines:
-            if   l.startswith("vmess://"):    ob=parse_vmess(l)
-            elif l.startswith("vless://"):    ob=parse_vless(l)
-            elif l.startswith("trojan://"):   ob=parse_trojan(l)
-            elif l.startswith("hysteria2://") or l.startswith("hy2://"): ob=parse_hysteria2(l)
-            elif l.startswith("tuic://"):     ob=parse_tuic(l)
-            else: ob=None
-            if ob: out.append(ob)
-        return out
-    # base64
-    d=b64maybe(raw)
-    if any(s in d for s in ("vmess://","vless://","trojan://","hysteria2://","hy2://","tuic://")):
-        out=[]
-        for l in [x.strip() for x in d.splitlines() if x.strip()]:
-            if   l.startswith("vmess://"):    ob=parse_vmess(l)
-            elif l.startswith("vless://"):    ob=parse_vless(l)
-            elif l.startswith("trojan://"):   ob=parse_trojan(l)
-            elif l.startswith("hysteria2://") or l.startswith("hy2://"): ob=parse_hysteria2(l)
-            elif l.startswith("tuic://"):     ob=parse_tuic(l)
-            else: ob=None
-            if ob: out.append(ob)
-        return out
-    # Clash YAML
-    if ("proxies:" in text) or ("proxy-providers:" in text) or ("proxies:" in d) or ("proxy-providers:" in d):
-        
-        nodes=parse_clash_yaml(text)
-        if not nodes: nodes=parse_clash_yaml(d)
-        return nodes
-    return []
+    return list(iter_subscription(http_stream(url)))
+
+# ====== 增量更新 ======
+def node_key(ob:dict):
+    """节点身份：协议 + 地址 + 端口 + 凭据（与名字无关）"""
+    cred=ob.get("uuid") or ob.get("password") or ""
+    return f"{ob.get('type')}|{ob.get('server')}|{ob.get('server_port')}|{cred}"
+
+def _keyed(nodes:list):
+    """node_key 加出现次数，重复节点也能一一对应"""
+    seen={}
+    for ob in nodes:
+        k=node_key(ob); n=seen.get(k,0); seen[k]=n+1
+        yield (f"{k}#{n}" if n else k), ob
+
+def merge_nodes(old:list, new:list):
+    """按 node_key 合并新旧节点：保留旧顺序、原地替换有变化的、新增的追加到末尾。
+    返回 (merged, diff, renames)；renames 为 旧 tag -> 新 tag"""
+    fresh=dict(_keyed(new))
+    merged, renames = [], {}
+    diff={"added":0,"removed":0,"changed":0,"unchanged":0}
+    for k,ob in _keyed(old):
+        nb=fresh.pop(k, None)
+        if nb is None: diff["removed"]+=1; continue
+        if nb==ob: diff["unchanged"]+=1
+        else:
+            diff["changed"]+=1
+            if nb.get("tag")!=ob.get("tag"): renames[ob.get("tag")]=nb.get("tag")
+        merged.append(nb)
+    merged.extend(fresh.values()); diff["added"]=len(fresh)
+    return merged, diff, renames
+
+def split_urls(text):
+    """多个订阅地址：列表，或按空白/换行分隔的字符串"""
+    if isinstance(text, (list, tuple)): text="\n".join(str(u) for u in text)
+    urls=[]
+    for u in (text or "").split():
+        if u not in urls: urls.append(u)
+    return urls
+
+def sub_urls_of(st:dict):
+    return st.get("sub_urls") or split_urls(st.get("sub_url",""))
+
+_SUB_POOL = ThreadPoolExecutor(max_workers=SUB_WORKERS, thread_name_prefix="sub")
+
+def sub_fetch_one(url:str, cache:dict):
+    """拉取并解析单个订阅（带重试）。返回 {"url","status","unchanged","nodes","validators","error","parse_ms","dupes"}"""
+    res={"url":url,"status":None,"unchanged":False,"nodes":None,"validators":cache,"error":None,"parse_ms":None,"dupes":0}
+    t0=time.perf_counter()
+    try: return _sub_fetch_one(url, cache, res)
+    finally:
+        result="error" if res["error"] else ("unchanged" if res["unchanged"] else "ok")
+        M_SUB_SECONDS.observe(M_SUB_SECONDS.labels(result), time.perf_counter()-t0)
+
+def _sub_fetch_one(url:str, cache:dict, res:dict):
+    for attempt in range(SUB_RETRIES+1):
+        if attempt: time.sleep(min(2**(attempt-1), 5))
+        try:
+            status, v, body = http_fetch(url, cache, timeout=SUB_TIMEOUT)
+            v["ts"]=time.time(); res.update(status=status, validators=v, error=None)
+            if status!=304: M_SUB_BYTES.inc(M_SUB_BYTES_C, v.get("size") or 0)
+            if status==304 or (cache.get("digest") and v.get("digest")==cache["digest"]):
+                if body: body.close()
+                res["unchanged"]=True; return res
+            t0=time.perf_counter(); stats={}
+            with body:
+                res["nodes"]=list(iter_subscription(iter_file(body), stats))
+            res["parse_ms"]=round((time.perf_counter()-t0)*1000, 1); res["dupes"]=stats.get("dupes",0)
+            for ob in res["nodes"]: ob["_src"]=url
+            return res
+        except urllib.error.HTTPError as e:
+            res["error"]=f"HTTP {e.code}"
+            if e.code<500 and e.code!=429: return res
+        except Exception as e:
+            res["error"]=str(e) or e.__class__.__name__
+    return res
+
+_REFRESH_LOCK = threading.Lock()
+
+def sub_refresh(urls, force=False):
+    """并发拉取所有订阅，按配置顺序合并、去重、统一命名，再与现有节点做增量合并。
+    未变化（304/摘要相同）或拉取失败的订阅沿用上次的节点。返回 (nodes, info)"""
+    with _REFRESH_LOCK:
+        return _sub_refresh(split_urls(urls), force)
+
+def _sub_refresh(urls:list, force=False):
+    old=nodes_load()
+    caches=state_load().get("sub_cache",{})
+    # 旧节点按来源归组（老版本没有 _src 的都算作第一个订阅）
+    by_src={}
+    for ob in old: by_src.setdefault(ob.get("_src") or urls[0], []).append(ob)
+    futs=[_SUB_POOL.submit(sub_fetch_one, u, {} if (force or u not in by_src) else caches.get(u,{})) for u in urls]
+    results=[f.result() for f in futs]
+
+    nodes, seen, used, sources = [], set(), TagSet(), []
+    for r in results:
+        parsed=r["nodes"] is not None
+        src_nodes=r["nodes"] if parsed else by_src.get(r["url"], [])
+        kept=0; dupes=r["dupes"] if parsed else 0
+        for ob in src_nodes:
+            k=node_key(ob)
+            if k in seen: dupes+=1; continue      # 不同订阅里的同一节点只留第一个
+            seen.add(k)
+            ob=dict(ob, _src=r["url"])
+            ob["tag"]=normalize_tag(ob.get("_name") or ob.get("tag"), used)
+            nodes.append(ob); kept+=1
+        sources.append({"url":r["url"],"ok":r["error"] is None,"unchanged":r["unchanged"],
+                        "parsed":parsed,"nodes":kept,"dupes":dupes,"error":r["error"],"parse_ms":r["parse_ms"]})
+    if not nodes:
+        errs="; ".join(f"{x['url']}: {x['error']}" for x in sources if x["error"])
+        raise ValueError("未解析到任何节点（可能是受保护/Provider 订阅）" + (f" [{errs}]" if errs else ""))
+    # 注入 resolver/iface
+    for ob in nodes:
+        if INJECT_RESOLVER_TAG: ob["domain_resolver"]={"server":INJECT_RESOLVER_TAG,"strategy":"ipv4_only"}
+        if INJECT_IFACE:        ob["bind_interface"]=INJECT_IFACE
+    merged, diff, renames = merge_nodes(old, nodes)
+    if diff["added"] or diff["removed"] or diff["changed"]:
+        nodes_save(merged)
+    # 拉取期间切换节点等可能已写过状态：只写订阅相关的键。当前节点只是改了名字时跟着改，保持选中状态
+    upd={"sub_cache":{r["url"]:r["validators"] for r in results if r["validators"]}, "sub_urls":urls, "sub_url":urls[0]}
+    with _STATE_STORE.lock:
+        last=state_load().get("last_node_tag","")
+        if last in renames: upd["last_node_tag"]=renames[last]
+        state_update(**upd)
+    _PARSE_CACHE.save()
+    RESOLVER.prefetch(merged)     # 后台批量解析，节点列表 / 探测 / mainout 直接用缓存
+    unchanged=not (diff["added"] or diff["removed"] or diff["changed"])
+    return merged, {"unchanged":unchanged,"diff":diff,"sources":sources,"parse_cache":_PARSE_CACHE.stats()}
+
+# ====== 节点域名解析 ======
+# 解析放在独立线程池里，请求线程只读缓存（peek），没有结果时提交后台解析并立即返回；
+# 成功结果缓存 DNS_TTL 秒，失败缓存 DNS_NEG_TTL 秒；过期后仍先返回旧结果，同时后台刷新
+_IP_RE = re.compile(r"^\d{1,3}(\.\d{1,3}){3}$|:")
+_DNS_FAMILY = {"ipv4_only":socket.AF_INET, "ipv6_only":socket.AF_INET6}
+
+def node_strategy(ob:dict) -> str:
+    return (ob.get("domain_resolver") or {}).get("strategy") or ob.get("domain_strategy") or DNS_STRATEGY
+
+class Resolver:
+    def __init__(self, workers:int):
+        # 用守护线程 + 队列而不是 ThreadPoolExecutor：后者在进程退出时要把排队的解析全部跑完
+        self.workers=workers; self.threads=[]; self.q=queue.Queue()
+        self.lock=threading.Lock()
+        self.cache={}     # (host, strategy) -> {"ips","error","dns_ms","ts","ttl"}
+        self.pending={}   # (host, strategy) -> Future
+        self.version=0    # 每有新结果 +1，用于节点列表的 ETag
+
+    def _resolve(self, key):
+        host, strategy = key
+        e={"ips":[],"error":None,"dns_ms":None,"ts":time.time(),"ttl":DNS_TTL}
+        try:
+            t0=time.monotonic()
+            infos=socket.getaddrinfo(host, None, _DNS_FAMILY.get(strategy, socket.AF_UNSPEC), socket.SOCK_STREAM)
+            e["dns_ms"]=round((time.monotonic()-t0)*1000,1)
+            ips=list(dict.fromkeys(ai[4][0] for ai in infos))
+            if strategy=="prefer_ipv4": ips.sort(key=lambda ip: ":" in ip)
+            elif strategy=="prefer_ipv6": ips.sort(key=lambda ip: ":" not in ip)
+            e["ips"]=ips
+        except Exception as ex:
+            e["error"]=str(ex) or ex.__class__.__name__
+        if not e["ips"]: e["ttl"]=DNS_NEG_TTL
+        with self.lock:
+            self.cache[key]=e; self.pending.pop(key, None); self.version+=1
+        return e
+
+    def _work(self):
+        while True:
+            key, f = self.q.get()
+            try: f.set_result(self._resolve(key))
+            except Exception as e: f.set_exception(e)
+
+    def _submit(self, key):
+        """调用方持有 self.lock"""
+        f=self.pending.get(key)
+        if f is None:
+            f=self.pending[key]=Future(); self.q.put((key, f))
+            if len(self.threads)<self.workers and self.q.qsize()>0:
+                t=threading.Thread(target=self._work, name=f"dns-{len(self.threads)}", daemon=True)
+                self.threads.append(t); t.start()
+        return f
+
+    def peek(self, host:str, strategy:str=DNS_STRATEGY):
+        """不阻塞：返回缓存条目（可能已过期）或 None；缺失/过期时安排后台解析"""
+        if not host: return None
+        if _IP_RE.search(host): return {"ips":[host],"error":None,"dns_ms":0.0,"ts":time.time(),"ttl":DNS_TTL}
+        key=(host, strategy)
+        with self.lock:
+            e=self.cache.get(key)
+            if e is None or time.time()-e["ts"]>=e["ttl"]: self._submit(key)
+        return e
+
+    def resolve(self, host:str, strategy:str=DNS_STRATEGY, timeout=None):
+        """阻塞直到有新鲜结果（或超时，超时返回旧结果/None）"""
+        e=self.peek(host, strategy)
+        if e is not None and (_IP_RE.search(host) or time.time()-e["ts"]<e["ttl"]): return e
+        with self.lock: f=self.pending.get((host, strategy))
+        if f is None: return self.peek(host, strategy)
+        try: return f.result(timeout=timeout)
+        except Exception: return e
+
+    def prefetch(self, nodes:list) -> list:
+        """批量安排解析（每个 host+策略只一次），返回提交的 Future 列表"""
+        futs=[]
+        keys={(ob.get("server"), node_strategy(ob)) for ob in nodes if ob.get("server")}
+        with self.lock:
+            for key in keys:
+                if _IP_RE.search(key[0]): continue
+                e=self.cache.get(key)
+                if e is None or time.time()-e["ts"]>=e["ttl"]: futs.append(self._submit(key))
+        return futs
+
+    def resolve_many(self, nodes:list, timeout=None):
+        """批量解析并等待（最多 timeout 秒）"""
+        futs=self.prefetch(nodes)
+        if futs: wait(futs, timeout=timeout)
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {"entries":len(self.cache),"pending":len(self.pending),
+                    "negative":sum(1 for e in self.cache.values() if not e["ips"])}
+
+RESOLVER = Resolver(DNS_WORKERS)
+
+def node_ip(ob:dict, block=False, timeout=None):
+    """节点服务器的首个 IP；block=False 时只看缓存（没有则返回 None 并在后台解析）"""
+    host=ob.get("server")
+    e=RESOLVER.resolve(host, node_strategy(ob), timeout) if block else RESOLVER.peek(host, node_strategy(ob))
+    return e["ips"][0] if e and e["ips"] else None
+
+# ====== 节点探测 ======
+# hysteria2/tuic 走 QUIC(UDP)，无法用 TCP 建连衡量，只做 DNS 解析
+UDP_TYPES = ("hysteria2", "tuic")
+
+_PROBE_POOL  = ThreadPoolExecutor(max_workers=PROBE_WORKERS, thread_name_prefix="probe")
+_PROBE_CACHE = {}   # probe_key -> 结果
+_PROBE_LOCK  = threading.Lock()
+_PROBE_VERSION = [0]   # 每批结果写入后 +1，用于节点列表的 ETag
+
+def probe_key(ob:dict, tls=False):
+    """同一 IP:端口 只测一次（多个域名/tag 指向同一中转时不重复）；未解析出 IP 时按域名"""
+    t=ob.get("tls") or {}
+    sni=(t.get("server_name") or ob.get("server")) if tls and t.get("enabled") else None
+    return (node_ip(ob) or ob.get("server"), int(ob.get("server_port") or 443), ob.get("type") in UDP_TYPES, sni)
+
+def probe_node(ob:dict, tls=False, timeout=PROBE_TIMEOUT):
+    """DNS 解析（走 RESOLVER 缓存）+ TCP 建连（+ TLS 握手），返回各阶段耗时（毫秒）"""
+    server=ob.get("server"); port=int(ob.get("server_port") or 443)
+    res={"ok":False,"ip":None,"dns_ms":None,"tcp_ms":None,"tls_ms":None,"latency_ms":None,"error":None,"ts":time.time()}
+    try:
+        e=RESOLVER.resolve(server, node_strategy(ob), timeout=timeout*2)
+        if not e or not e["ips"]: raise OSError((e or {}).get("error") or "DNS 解析失败")
+        res["dns_ms"]=e["dns_ms"]; res["ip"]=e["ips"][0]
+        if ob.get("type") in UDP_TYPES:
+            res["ok"]=True; return res
+        t1=time.monotonic()
+        sock=socket.create_connection((res["ip"], port), timeout=timeout)
+        try:
+            res["tcp_ms"]=round((time.monotonic()-t1)*1000,1)
+            t=ob.get("tls") or {}
+            if tls and t.get("enabled"):
+                ctx=ssl.create_default_context()
+                ctx.check_hostname=False; ctx.verify_mode=ssl.CERT_NONE
+                if t.get("alpn"): ctx.set_alpn_protocols([a for a in t["alpn"] if a])
+                t2=time.monotonic()
+                sock=ctx.wrap_socket(sock, server_hostname=t.get("server_name") or server)
+                res["tls_ms"]=round((time.monotonic()-t2)*1000,1)
+        finally:
+            sock.close()
+        res["latency_ms"]=round(res["tcp_ms"]+(res["tls_ms"] or 0),1)
+        res["ok"]=True
+    except Exception as e:
+        res["error"]=str(e) or e.__class__.__name__
+    return res
+
+def probe_cached(ob:dict, tls=False):
+    """取未过期的探测结果，没有则返回 None"""
+    with _PROBE_LOCK:
+        r=_PROBE_CACHE.get(probe_key(ob, tls))
+    if r and time.time()-r["ts"]<PROBE_TTL: return r
+    return None
+
+def probe_nodes(nodes:list, tls=False, force=False):
+    """并发探测一批节点，相同 IP/端口 只测一次；返回与 nodes 对齐的结果列表"""
+    # 先批量解析，让指向同一 IP 的节点合并成一个探测
+    RESOLVER.resolve_many(nodes, timeout=PROBE_TIMEOUT*2)
+    keys=[probe_key(ob, tls) for ob in nodes]
+    results, futs = {}, {}
+    for k,ob in zip(keys, nodes):
+        if k in results or k in futs: continue
+        r=None if force else probe_cached(ob, tls)
+        if r: results[k]=r
+        else: futs[k]=_PROBE_POOL.submit(probe_node, ob, tls)
+    # socket 已带超时，这里再兜底一次（DNS 解析本身不受 socket 超时控制）
+    wait(list(futs.values()), timeout=PROBE_TIMEOUT*3+len(futs)/max(PROBE_WORKERS,1)*PROBE_TIMEOUT)
+    with _PROBE_LOCK:
+        for k,f in futs.items():
+            r=f.result() if f.done() else {"ok":False,"ip":None,"dns_ms":None,"tcp_ms":None,"tls_ms":None,
+                                          "latency_ms":None,"error":"timeout","ts":time.time()}
+            _PROBE_CACHE[k]=results[k]=r
+        if futs: _PROBE_VERSION[0]+=1
+    return [results[k] for k in keys]
+
+def node_meta(i:int, n:dict):
+    """节点列表项（前端展示用），带上缓存中的探测结果"""
+    m={"idx":i,"tag":n.get("tag"),"name":n.get("_name") or n.get("tag"),"type":n.get("type"),
+       "server":n.get("server"),"server_port":n.get("server_port"),"src":n.get("_src"),"ip":node_ip(n)}
+    r=probe_cached(n, PROBE_TLS)
+    if r: m.update(reachable=r["ok"], latency_ms=r["latency_ms"])
+    m["speed_mbps"]=speed_of(n)
+    return m
+
+META_FIELDS = ("idx","tag","name","type","server","server_port","src","ip","reachable","latency_ms","speed_mbps")
+NODE_SORTS = ("idx","name","latency","type","ip","speed")
+
+def _latency_rank(m:dict):
+    # 可达且有延迟的在前（按延迟），未测的居中，不可达的最后
+    if m.get("reachable") is None: return (1, 0.0)
+    if not m["reachable"]: return (2, 0.0)
+    lat=m.get("latency_ms")
+    return (0, lat if lat is not None else 0.0)
+
+def nodes_query(q:str="", types=None, src:str=None, sort:str="idx", desc=False,
+                page:int=1, size:int=NODE_PAGE_SIZE, fields=None, ip:str=None) -> dict:
+    """节点列表的筛选/排序/分页/字段投影"""
+    nodes=nodes_load()
+    q=(q or "").strip().lower()
+    if isinstance(types, str): types=[t for t in types.split(",") if t]
+    idxs=nodes_find(typ=types[0]) if types and len(types)==1 else range(len(nodes))
+    tset=set(types or [])
+    rows=[]
+    for i in idxs:
+        n=nodes[i]
+        if tset and n.get("type") not in tset: continue
+        if src and n.get("_src")!=src: continue
+        if q and q not in (n.get("tag") or "").lower() and q not in (n.get("_name") or "").lower() \
+             and q not in str(n.get("server") or "").lower(): continue
+        m=node_meta(i, n)
+        if ip and m["ip"]!=ip: continue
+        rows.append(m)
+    key={"idx":lambda m:m["idx"], "name":lambda m:(m["name"] or "").lower(),
+         "latency":_latency_rank, "type":lambda m:(m["type"] or "", m["idx"]),
+         "ip":lambda m:(m["ip"] is None, m["ip"] or "", m["idx"]),
+         "speed":lambda m:(m["speed_mbps"] is None, -(m["speed_mbps"] or 0.0), m["idx"])}.get(sort, lambda m:m["idx"])
+    rows.sort(key=key, reverse=bool(desc))
+    size=max(1, min(int(size), 1000)); page=max(1, int(page))
+    total=len(rows); pages=max(1, -(-total//size))
+    rows=rows[(page-1)*size: page*size]
+    if fields:
+        keep=[f for f in fields if f in META_FIELDS]
+        if "idx" not in keep: keep.insert(0, "idx")
+        rows=[{f:m.get(f) for f in keep} for m in rows]
+    return {"total":total,"all":len(nodes),"page":page,"pages":pages,"size":size,"nodes":rows}
+
+def node_list_args(data:dict) -> dict:
+    fields=data.get("fields")
+    if isinstance(fields, str): fields=[f for f in fields.split(",") if f]
+    return {"q":data.get("q",""),"types":data.get("type"),"src":data.get("src"),"ip":data.get("ip"),
+            "sort":data.get("sort","idx") if data.get("sort") in NODE_SORTS else "idx",
+            "desc":bool(data.get("desc")),"page":data.get("page",1),
+            "size":data.get("size",NODE_PAGE_SIZE),"fields":fields}
 
 # ====== 配置替换 ======
-def replace_main_out(cfg:dict, node:dict) -> dict:
-    found=False
-    for i,ob in enumerate(cfg.get("outbounds",[])):
-        if ob.get("tag")=="main-out":
-            n2=json.loads(json.dumps(node)); n2["tag"]="main-out"
-            cfg["outbounds"][i]=n2; found=True; break
-    if not found:
-        n2=json.loads(json.dumps(node)); n2["tag"]="main-out"
-        cfg.setdefault("outbounds",[]).append(n2)
-        cfg.setdefault("route",{}).setdefault("final","main-out")
-    return cfg
+def outbound_of(node:dict) -> dict:
+    """去掉 _src/_name 等内部字段，得到可写入 sing-box 配置的 outbound"""
+    return {k:v for k,v in node.items() if not k.startswith("_")}
 
 # ====== 路由 ======
 @app.route("/")
@@ -486,113 +1748,464 @@ def api_init():
     ok_auth, resp = must_auth()
     if not ok_auth: return resp
     st = state_load()
-    nodes = nodes_load()
-    meta=[{"idx":i,"tag":n.get("tag"),"type":n.get("type"),
-           "server":n.get("server"),"server_port":n.get("server_port")} for i,n in enumerate(nodes)]
-    return ok("init", sub_url=st.get("sub_url",""), nodes=meta, last_tag=st.get("last_node_tag",""))
+    data=request.get_json(force=True, silent=True) or {}
+    lst=nodes_query(**node_list_args(data))
+    return ok("init", sub_url=st.get("sub_url",""), sub_urls=sub_urls_of(st), last_tag=st.get("last_node_tag",""), **lst)
+
+@app.route("/api/nodes", methods=["POST"])
+def api_nodes():
+    """分页节点列表；请求体同 node_list_args，带 ETag，未变化时返回 304"""
+    ok_auth, resp = must_auth()
+    if not ok_auth: return resp
+    data=request.get_json(force=True, silent=True) or {}
+    args=node_list_args(data)
+    nodes_load()
+    last=state_load().get("last_node_tag","")
+    tag=hashlib.sha1(_dumps([_NODE_STORE.version, _PROBE_VERSION[0], RESOLVER.version, _SPEED["version"], int(time.time()//PROBE_TTL),
+                             last, args]).encode()).hexdigest()[:20]
+    etag=f'W/"{tag}"'
+    if etag in (request.headers.get("If-None-Match") or ""):
+        return Response(status=304, headers={"ETag":etag})
+    resp=ok("nodes", last_tag=last, **nodes_query(**args))
+    resp.headers["ETag"]=etag
+    return resp
+
+def do_sub_fetch(urls, force=False) -> dict:
+    try:
+        nodes, info = sub_refresh(urls, force=force)
+        st=state_load()
+        lst=nodes_query()
+        d=info["diff"]
+        msg=(f"订阅未变化，共 {len(nodes)} 个节点" if info["unchanged"] else
+             f"解析 {len(nodes)} 个节点（新增 {d['added']} / 移除 {d['removed']} / 变更 {d['changed']}）")
+        bad=[x for x in info["sources"] if x["error"]]
+        if bad: msg+=f"，{len(bad)} 个订阅拉取失败（沿用上次节点）"
+        return {"ok":True,"msg":msg,**lst,"last_tag":st.get("last_node_tag",""),"diff":d,
+                "unchanged":info["unchanged"],"sources":info["sources"],
+                "stderr":"\n".join(f"{x['url']}: {x['error']}" for x in bad)}
+    except ValueError as e:
+        return {"ok":False,"msg":str(e)}
+    except Exception as e:
+        return {"ok":False,"msg":f"拉取失败: {e}"}
 
 @app.route("/api/sub/fetch", methods=["POST"])
 def api_sub_fetch():
     ok_auth, resp = must_auth()
     if not ok_auth: return resp
     data=request.get_json(force=True) or {}
-    url=data.get("url","").strip()
-    if not url:
-        st=state_load(); url=st.get("sub_url","").strip()
-    if not url: return err("缺少订阅 URL")
+    urls=split_urls(data.get("urls") or data.get("url",""))
+    if not urls: urls=sub_urls_of(state_load())
+    if not urls: return err("缺少订阅 URL")
+    force=bool(data.get("force"))
+    if data.get("async"): return ok("已提交", job=job_submit("fetch", do_sub_fetch, urls, force))
+    return respond(do_sub_fetch(urls, force))
+
+@app.route("/api/nodes/probe", methods=["POST"])
+def api_nodes_probe():
+    ok_auth, resp = must_auth()
+    if not ok_auth: return resp
+    data=request.get_json(force=True, silent=True) or {}
+    nodes=nodes_load()
+    if not nodes: return err("未获取订阅")
+    idxs=data.get("indices")
+    if idxs is None: idxs=range(len(nodes))
+    idxs=[int(i) for i in idxs if 0<=int(i)<len(nodes)]
+    tls=bool(data.get("tls", PROBE_TLS))
+    t0=time.monotonic()
+    rs=probe_nodes([nodes[i] for i in idxs], tls=tls, force=bool(data.get("force")))
+    results=[dict(r, idx=i, tag=nodes[i].get("tag")) for i,r in zip(idxs, rs)]
+    alive=sum(1 for r in rs if r["ok"])
+    return ok(f"探测 {len(results)} 个节点，可达 {alive} 个", results=results,
+              elapsed_ms=round((time.monotonic()-t0)*1000,1))
+
+# ====== Clash API ======
+def clash_api(method:str, path:str, body=None, timeout=3):
+    """调用 sing-box 的 Clash 兼容 API；返回 JSON（无内容时为 None），失败抛异常"""
+    headers={"Content-Type":"application/json"}
+    if CLASH_SECRET: headers["Authorization"]=f"Bearer {CLASH_SECRET}"
+    data=json.dumps(body).encode() if body is not None else None
+    req=urllib.request.Request(f"http://{CLASH_API}{path}", data=data, method=method, headers=headers)
+    with urllib.request.urlopen(req, timeout=timeout) as r:
+        raw=r.read()
+    return json.loads(raw) if raw.strip() else None
+
+def ensure_clash_api(cfg:dict) -> dict:
+    api=cfg.setdefault("experimental",{}).setdefault("clash_api",{})
+    api["external_controller"]=CLASH_API
+    if CLASH_SECRET: api["secret"]=CLASH_SECRET
+    return cfg
+
+def nodes_digest(nodes:list) -> str:
+    return hashlib.sha256(json.dumps([outbound_of(n) for n in nodes], sort_keys=True).encode()).hexdigest()
+
+def render_selector(cfg:dict, nodes:list, default_tag:str, prev_tags=()) -> (dict, list):
+    """全部节点写进 outbounds，main-out 改为 selector；prev_tags 为上次写入的节点（先移除）。
+    返回 (cfg, 写入的节点 tag 列表)"""
+    prev=set(prev_tags)
+    base=[o for o in cfg.get("outbounds",[]) if o.get("tag")!="main-out" and o.get("tag") not in prev]
+    reserved={o.get("tag") for o in base}
+    outs, tags = [], []
+    for n in nodes:
+        tag=n.get("tag")
+        if not tag or tag in reserved or tag=="main-out": continue   # 与内置出站重名的跳过
+        reserved.add(tag); tags.append(tag)
+        outs.append(outbound_of(n))
+    sel={"type":"selector","tag":"main-out","outbounds":tags,
+         "default":default_tag if default_tag in tags else (tags[0] if tags else None),
+         "interrupt_exist_connections":False}
+    cfg["outbounds"]=base+[sel]+outs
+    cfg.setdefault("route",{}).setdefault("final","main-out")
+    return ensure_clash_api(cfg), tags
+
+def select_nodes(nodes:list, match:str=None, types=None, max_ms=None, limit=None, idxs=None) -> list:
+    """按 tag/名称正则、协议、已测延迟筛选节点，返回下标。结果确定：按下标排序；
+    给了 limit 时按延迟（相同则下标）取前 limit 个。max_ms 只保留测过且不超过该值的节点"""
+    rx=re.compile(match, re.I) if match else None
+    if isinstance(types, str): types=[t for t in types.split(",") if t]
+    tset=set(types or []); want=set(int(i) for i in idxs) if idxs else None
+    lat={}
+    out=[]
+    for i,n in enumerate(nodes):
+        if want is not None and i not in want: continue
+        if tset and n.get("type") not in tset: continue
+        if rx and not (rx.search(n.get("tag") or "") or rx.search(n.get("_name") or "")): continue
+        if max_ms is not None or limit:
+            r=probe_cached(n, PROBE_TLS) or probe_cached(n, not PROBE_TLS)
+            lat[i]=r["latency_ms"] if r and r["ok"] and r["latency_ms"] is not None else None
+            if max_ms is not None and (lat[i] is None or lat[i]>float(max_ms)): continue
+        out.append(i)
+    if limit:
+        out=sorted(out, key=lambda i:(lat[i] is None, lat[i] or 0.0, i))[:int(limit)]
+        out.sort()
+    return out
+
+def render_group(cfg:dict, nodes:list, prev_tags=(), interval:str=URLTEST_INTERVAL,
+                 tolerance:int=URLTEST_TOLERANCE, url:str=URLTEST_URL) -> (dict, list):
+    """节点写进 outbounds：URLTEST_TAG(urltest) 包含全部节点，main-out(selector) = [urltest] + 各节点，默认 urltest。
+    返回 (cfg, 写入的节点 tag 列表)"""
+    cfg, tags = render_selector(cfg, [n for n in nodes if n.get("tag")!=URLTEST_TAG], None, list(prev_tags)+[URLTEST_TAG])
+    ut={"type":"urltest","tag":URLTEST_TAG,"outbounds":tags,"url":url,"interval":interval,
+        "tolerance":int(tolerance),"interrupt_exist_connections":False}
+    outs=cfg["outbounds"]
+    pos=next(i for i,o in enumerate(outs) if o.get("tag")=="main-out")
+    sel=outs[pos]; sel["outbounds"]=[URLTEST_TAG]+tags; sel["default"]=URLTEST_TAG
+    outs.insert(pos+1, ut)
+    return cfg, tags
+
+def strip_fast_nodes(cfg:dict, prev_tags) -> dict:
+    """退出快速切换模式时去掉上次写入的节点"""
+    prev=set(prev_tags)
+    if prev: cfg["outbounds"]=[o for o in cfg.get("outbounds",[]) if o.get("tag") not in prev]
+    return cfg
+
+# ====== 配置写入 ======
+# 先写临时文件并 fsync，sing-box check 通过后再 rename 覆盖，任何时刻 SB_CFG 都是完整可用的；
+# 旧文件硬链接为 .bak。check 结果按 (sing-box 二进制, 配置内容) 的摘要缓存，在几个常用节点间来回切换时不再重复 fork
+CHECK_CACHE_SIZE = 64
+_CHECK_CACHE = OrderedDict()    # digest -> {"ok","stdout","stderr"}
+_CHECK_LOCK  = threading.Lock()
+
+def cfg_render(cfg:dict) -> str:
+    return json.dumps(cfg, ensure_ascii=False, indent=2)
+
+def _check_key(raw:str) -> str:
+    return hashlib.sha256((repr(_file_sig(SB_BIN))+"\n"+raw).encode()).hexdigest()
+
+def _check_cached(key:str):
+    with _CHECK_LOCK:
+        if not _CHECK_CACHE:
+            _CHECK_CACHE.update(state_load().get("cfg_checks",{}))
+        r=_CHECK_CACHE.get(key)
+        if r is not None: _CHECK_CACHE.move_to_end(key)
+        return r
+
+def _check_store(key:str, r:dict):
+    with _CHECK_LOCK:
+        _CHECK_CACHE[key]=r; _CHECK_CACHE.move_to_end(key)
+        while len(_CHECK_CACHE)>CHECK_CACHE_SIZE: _CHECK_CACHE.popitem(last=False)
+        keep=dict(_CHECK_CACHE)
+    state_update(cfg_checks=keep)
+
+def cfg_commit(raw:str, cfg:dict=None):
+    """校验并原子替换配置文件。返回 (ok, stdout, stderr, info)，info = {"written","cached"}。
+    cfg 为 raw 对应的字典（可选），用于直接更新 cfg_load 的缓存，省一次重新解析"""
+    info={"written":False,"cached":False}
     try:
-        nodes=parse_subscription(url)
-        if not nodes: return err("未解析到任何节点（可能是受保护/Provider 订阅）")
-        # 注入 resolver/iface
-        for ob in nodes:
-            if INJECT_RESOLVER_TAG: ob["domain_resolver"]={"server":INJECT_RESOLVER_TAG,"strategy":"ipv4_only"}
-            if INJECT_IFACE:        ob["bind_interface"]=INJECT_IFACE
-        # 保存 URL 与节点
-        st=state_load(); st["sub_url"]=url; state_save(st)
-        nodes_save(nodes)
-        meta=[{"idx":i,"tag":n.get("tag"),"type":n.get("type"),
-               "server":n.get("server"),"server_port":n.get("server_port")} for i,n in enumerate(nodes)]
-        return ok(f"解析 {len(nodes)} 个节点", nodes=meta, last_tag=st.get("last_node_tag",""))
-    except Exception as e:
-        return err(f"拉取失败: {e}")
+        with open(SB_CFG) as f: same=f.read()==raw
+    except OSError: same=False
+    if same: return True, "", "", info            # 内容没变，不写也不查
+    os.makedirs(os.path.dirname(os.path.abspath(SB_CFG)), exist_ok=True)
+    tmp=f"{SB_CFG}.new"
+    t0=time.perf_counter()
+    with open(tmp,"w") as f:
+        f.write(raw); f.flush(); os.fsync(f.fileno())
+    t_write=time.perf_counter()-t0
+    key=_check_key(raw)
+    r=_check_cached(key)
+    if r is None:
+        with timed(M_APPLY_SECONDS, M_APPLY_SECONDS.labels("check")):
+            ok1, out1, err1 = run(f"{SB_BIN} check -c {shlex.quote(tmp)}")
+        r={"ok":ok1,"stdout":out1,"stderr":err1}
+        _check_store(key, r)
+        M_CHECK_TOTAL.inc(M_CHECK_TOTAL.labels("miss"))
+    else:
+        info["cached"]=True
+        M_CHECK_TOTAL.inc(M_CHECK_TOTAL.labels("hit"))
+    if not r["ok"]:
+        try: os.unlink(tmp)
+        except OSError: pass
+        return False, r["stdout"], r["stderr"], info
+    bak=f"{SB_CFG}.bak"
+    try:
+        if os.path.exists(bak): os.unlink(bak)
+        os.link(SB_CFG, bak)
+    except OSError:
+        pass
+    t0=time.perf_counter()
+    os.replace(tmp, SB_CFG)
+    try:
+        dfd=os.open(os.path.dirname(os.path.abspath(SB_CFG)), os.O_RDONLY)
+        try: os.fsync(dfd)
+        finally: os.close(dfd)
+    except OSError:
+        pass
+    M_APPLY_SECONDS.observe(M_APPLY_SECONDS.labels("write"), t_write+time.perf_counter()-t0)
+    if cfg is not None: _CFG_CACHE.update(sig=_file_sig(SB_CFG), cfg=cfg)
+    info["written"]=True
+    return True, r["stdout"], r["stderr"], info
+
+def cfg_write_checked(cfg:dict):
+    """写配置并 sing-box check；失败时原文件不动。返回 (ok, stdout, stderr)"""
+    ok1, out1, err1, _ = cfg_commit(cfg_render(cfg), cfg)
+    return ok1, out1, err1
+
+# main-out 之外的部分渲染一次做成模板，切换节点时只把 main-out 的 JSON 填进去
+_MAINOUT_MARK = "\u0000main-out\u0000"
+_MAINOUT_TPL  = {"key":None}
+
+def _mainout_template(prev_tags) -> dict:
+    """以当前配置（去掉快速切换节点、确保 clash_api）为底，main-out 位置放占位符"""
+    key=(_file_sig(SB_CFG), tuple(prev_tags), CLASH_API, CLASH_SECRET)
+    if _MAINOUT_TPL["key"]==key: return _MAINOUT_TPL
+    cfg=ensure_clash_api(strip_fast_nodes(cfg_editable(), prev_tags))
+    outs=list(cfg.get("outbounds",[]))
+    pos=next((i for i,o in enumerate(outs) if o.get("tag")=="main-out"), None)
+    if pos is None:
+        pos=len(outs); outs.append(None)
+        cfg.setdefault("route",{}).setdefault("final","main-out")
+    outs[pos]=_MAINOUT_MARK; cfg["outbounds"]=outs
+    _MAINOUT_TPL.clear()
+    _MAINOUT_TPL.update(key=key, cfg=cfg, pos=pos, text=cfg_render(cfg))
+    return _MAINOUT_TPL
+
+def cfg_apply_main_out(node:dict, prev_tags=()):
+    """只替换 main-out 写入配置。返回 (ok, stdout, stderr, info)"""
+    tpl=_mainout_template(prev_tags)
+    ob=dict(outbound_of(node), tag="main-out")
+    body=json.dumps(ob, ensure_ascii=False, indent=2).replace("\n", "\n    ")
+    raw=tpl["text"].replace(json.dumps(_MAINOUT_MARK), body, 1)
+    outs=list(tpl["cfg"]["outbounds"]); outs[tpl["pos"]]=ob
+    r=cfg_commit(raw, dict(tpl["cfg"], outbounds=outs))
+    if r[3]["written"]:
+        # 其余部分没变，模板对新文件继续有效
+        tpl["key"]=(_file_sig(SB_CFG),)+tpl["key"][1:]
+    return r
+
+def inject_iface(node:dict, iface:str):
+    if INJECT_RESOLVER_TAG: node["domain_resolver"]={"server":INJECT_RESOLVER_TAG,"strategy":"ipv4_only"}
+    if iface:               node["bind_interface"]=iface
+    return node
+
+_APPLY_LOCK = threading.RLock()
+
+def apply_node(idx:int, fast=None) -> dict:
+    """切换到第 idx 个节点。快速模式下优先走 Clash API，失败或节点集合变化时回退到改配置 + 重启。
+    返回 {"ok","msg","stdout","stderr","mode"}"""
+    with _APPLY_LOCK:     # 页面、任务、故障切换线程可能同时触发
+        t0=time.perf_counter()
+        r=_apply_node(idx, fast)
+        M_APPLY_SECONDS.observe(M_APPLY_SECONDS.labels("total"), time.perf_counter()-t0)
+        M_APPLY_TOTAL.inc(M_APPLY_TOTAL.labels(r.get("mode") or "none", "ok" if r["ok"] else "fail"))
+        return r
+
+def _apply_node(idx:int, fast=None) -> dict:
+    fast=FAST_SWITCH if fast is None else fast
+    nodes = [dict(n) for n in nodes_load()] if fast else nodes_load()
+    if idx<0 or idx>=len(nodes): return {"ok":False,"msg":"index 超界或未获取订阅"}
+    node=nodes[idx] if fast else dict(nodes[idx]); tag=node.get("tag","")
+    fs=state_load().get("fast_switch") or {}
+    # 再次注入
+    iface = get_system_interface()
+    for n in (nodes if fast else [node]): inject_iface(n, iface)
+    if fast and fs.get("digest")==nodes_digest(nodes) and tag in fs.get("tags",[]):
+        try:
+            clash_api("PUT", "/proxies/main-out", {"name": tag})
+            state_update(last_node_tag=tag)
+            return {"ok":True,"msg":f"已切换：{tag}","stdout":"","stderr":"","mode":"clash_api"}
+        except Exception as e:
+            fail=f"Clash API 切换失败，改为重写配置: {e}\n"
+    else:
+        fail=""
+    mode="restart"; new_fs=fs
+    if fast:
+        cfg2, tags = render_selector(cfg_editable(), nodes, tag, fs.get("tags",[]))
+        ok1, out1, err1 = cfg_write_checked(cfg2)
+        if ok1:
+            mode="selector"; new_fs={"digest":nodes_digest(nodes),"tags":tags}
+        else:
+            # selector 配置不通过时回退到单节点
+            fail+=f"selector 配置检查失败，回退单节点: {err1}\n"
+    if mode=="restart":
+        # 替换 main-out
+        ok1, out1, err1, _ = cfg_apply_main_out(node, fs.get("tags",[]))
+        if not ok1:
+            return {"ok":False,"msg":"配置检查失败","stdout":out1,"stderr":fail+err1}
+        new_fs=None
+    with timed(M_APPLY_SECONDS, M_APPLY_SECONDS.labels("restart")):
+        ok2, out2, err2 = unit_action("restart")
+    # 记录 last_node_tag；cfg_commit 期间可能写过 cfg_checks，这里只改自己的字段
+    state_update(last_node_tag=tag, fast_switch=new_fs)
+    return {"ok":True,"msg":f"已应用：{tag}","stdout":out1+"\n"+out2,"stderr":fail+err1+"\n"+err2,"mode":mode}
+
+GROUP_ARGS = ("match","type","max_ms","limit","idxs","interval","tolerance","url")
+
+def apply_group(opts:dict) -> dict:
+    """批量应用：按 opts 筛选节点，生成 urltest + selector 配置并重启。返回 {"ok","msg","stdout","stderr","mode",...}"""
+    with _APPLY_LOCK:
+        t0=time.perf_counter()
+        r=_apply_group(opts)
+        M_APPLY_SECONDS.observe(M_APPLY_SECONDS.labels("total"), time.perf_counter()-t0)
+        M_APPLY_TOTAL.inc(M_APPLY_TOTAL.labels("urltest", "ok" if r["ok"] else "fail"))
+        return r
+
+def _apply_group(opts:dict) -> dict:
+    nodes=[dict(n) for n in nodes_load()]
+    try:
+        sel=select_nodes(nodes, opts.get("match"), opts.get("type"), opts.get("max_ms"), opts.get("limit"), opts.get("idxs"))
+    except re.error as e:
+        return {"ok":False,"msg":f"正则错误: {e}"}
+    if not sel: return {"ok":False,"msg":"没有符合条件的节点"}
+    iface=get_system_interface()
+    for n in nodes: inject_iface(n, iface)
+    fs=state_load().get("fast_switch") or {}
+    cfg2, tags = render_group(cfg_editable(), [nodes[i] for i in sel], fs.get("tags",[]),
+                              opts.get("interval") or URLTEST_INTERVAL,
+                              opts.get("tolerance") if opts.get("tolerance") is not None else URLTEST_TOLERANCE,
+                              opts.get("url") or URLTEST_URL)
+    if opts.get("dry_run"):
+        return {"ok":True,"msg":f"将写入 {len(tags)} 个节点","tags":tags,"mode":"urltest","stdout":"","stderr":""}
+    ok1, out1, err1 = cfg_write_checked(cfg2)
+    if not ok1: return {"ok":False,"msg":"配置检查失败","stdout":out1,"stderr":err1}
+    # 与快速切换共用记录：tags 用于下次切换时移除；之后切到组内节点可直接走 Clash API
+    new_fs={"digest":nodes_digest(nodes),"tags":tags+[URLTEST_TAG],
+            "group":{k:opts.get(k) for k in GROUP_ARGS if opts.get(k) is not None}}
+    with timed(M_APPLY_SECONDS, M_APPLY_SECONDS.labels("restart")):
+        ok2, out2, err2 = unit_action("restart")
+    state_update(last_node_tag=URLTEST_TAG, fast_switch=new_fs)
+    return {"ok":True,"msg":f"已应用 urltest 组：{len(tags)} 个节点","tags":tags,"mode":"urltest",
+            "stdout":out1+"\n"+out2,"stderr":err1+"\n"+err2}
 
 # ====== 切换节点 ======
+@app.route("/api/sub/apply_group", methods=["POST"])
+def api_sub_apply_group():
+    """{"match":"港|HK","type":"vless,trojan","max_ms":300,"limit":50,"idxs":[...],
+        "interval":"3m","tolerance":50,"dry_run":false,"async":false}"""
+    ok_auth, resp = must_auth()
+    if not ok_auth: return resp
+    data=request.get_json(force=True, silent=True) or {}
+    opts={k:data.get(k) for k in GROUP_ARGS+("dry_run",)}
+    if data.get("async"): return ok("已提交", job=job_submit("apply_group", apply_group, opts))
+    return respond(apply_group(opts))
+
 @app.route("/api/sub/apply", methods=["POST"])
 def api_sub_apply():
     ok_auth, resp = must_auth()
     if not ok_auth: return resp
     data=request.get_json(force=True) or {}
     idx=int(data.get("index",-1))
-    nodes = nodes_load()
-    if idx<0 or idx>=len(nodes): return err("index 超界或未获取订阅")
-    node=nodes[idx]
-    # 再次注入
-    INJECT_IFACE = get_system_interface()
-    if INJECT_RESOLVER_TAG: node["domain_resolver"]={"server":INJECT_RESOLVER_TAG,"strategy":"ipv4_only"}
-    if INJECT_IFACE:        node["bind_interface"]=INJECT_IFACE
-    # 替换 main-out
-    cfg=json.load(open(SB_CFG))
-    cfg2=replace_main_out(cfg, node)
-    bak=f"{SB_CFG}.bak"; 
-    try: os.replace(SB_CFG, bak)
-    except Exception: pass
-    with open(SB_CFG,"w") as f: json.dump(cfg2,f,ensure_ascii=False,indent=2)
-    ok1, out1, err1 = run(f"{SB_BIN} check -c {SB_CFG}")
-    if not ok1:
-        if os.path.exists(bak): os.replace(bak, SB_CFG)
-        return err("配置检查失败", stdout=out1, stderr=err1)
-    ok2, out2, err2 = run(f"systemctl restart {SB_SVC}")
-    # 记录 last_node_tag
-    st=state_load(); st["last_node_tag"]=node.get("tag",""); state_save(st)
-    return ok(f"已应用：{node.get('tag')}", stdout=out1+"\n"+out2, stderr=err1+"\n"+err2)
+    if data.get("async"): return ok("已提交", job=job_submit("apply", apply_node, idx, data.get("fast")))
+    return respond(apply_node(idx, fast=data.get("fast")))
+
+@app.route("/api/jobs/<jid>", methods=["POST"])
+def api_job(jid):
+    ok_auth, resp = must_auth()
+    if not ok_auth: return resp
+    j=job_get(jid)
+    if not j: return err("任务不存在")
+    return ok(j["state"], job=j)
+
+@app.route("/api/jobs", methods=["POST"])
+def api_jobs():
+    ok_auth, resp = must_auth()
+    if not ok_auth: return resp
+    with _JOBS_LOCK:
+        jobs=[{k:v for k,v in j.items() if k!="result"} for j in _JOBS.values()]
+    return ok("jobs", jobs=sorted(jobs, key=lambda j:j["created"], reverse=True))
 
 
 @app.route("/api/status", methods=["POST"])
 def api_status():
     ok_auth, resp = must_auth()
     if not ok_auth: return resp
-    ok1, out, err1 = run(f"systemctl status {SB_SVC} --no-pager --full")
-    return ok("status", stdout=out, stderr=err1)
+    data=request.get_json(force=True, silent=True) or {}
+    if data.get("full"):
+        ok1, out, err1 = run(f"systemctl status {SB_SVC} --no-pager --full")
+        return ok("status", stdout=out, stderr=err1)
+    st=unit_state()
+    return ok("status", stdout=unit_status_text(st), stderr="", svc=st.get("ActiveState",""), unit=st)
 
 @app.route("/api/start", methods=["POST"])
 def api_start():
     ok_auth, resp = must_auth()
     if not ok_auth: return resp
-    ok1, out, err1 = run(SB_START)
-    ok2, out2, _ = run(f"systemctl is-active {SB_SVC}")
-    return ok("start", stdout=out, stderr=err1, svc=out2.strip())
+    if NET_MODE=="script": ok1, out, err1 = run(SB_START)
+    else:
+        ok1, out, err1 = net_up()
+        if ok1:
+            ok1, o, e = unit_action("restart"); out+="\n"+o; err1+=e
+    svc=unit_state(fresh=True).get("ActiveState","")
+    return ok("start", stdout=out, stderr=err1, svc=svc)
 
 @app.route("/api/stop", methods=["POST"])
 def api_stop():
     ok_auth, resp = must_auth()
     if not ok_auth: return resp
-    ok1, out, err1 = run(SB_STOP)
-    ok2, out2, _ = run(f"systemctl is-active {SB_SVC}")
-    return ok("stop", stdout=out, stderr=err1, svc=out2.strip())
+    if NET_MODE=="script": ok1, out, err1 = run(SB_STOP)
+    else:
+        ok1, out, err1 = unit_action("stop")    # 先停 sing-box，避免默认路由仍指向 TUN
+        _, o, e = net_down(); out+="\n"+o; err1+=e
+    svc=unit_state(fresh=True).get("ActiveState","")
+    return ok("stop", stdout=out, stderr=err1, svc=svc)
 
 @app.route("/api/config/mainout", methods=["POST"])
 def api_cfg_mainout():
     if not (TOKEN and request.headers.get("X-Token","")==TOKEN):
         return jsonify(ok=False, msg="Unauthorized"), 401
     try:
-        cfg = json.load(open(SB_CFG))
+        cfg = cfg_load()
         ob = next((o for o in cfg.get("outbounds",[]) if o.get("tag")=="main-out"), None)
         if not ob:
             return jsonify(ok=True, msg="no main-out", node={})
+        if ob.get("type")=="selector":
+            # 快速切换模式：取 selector 当前选中的节点
+            try: now=(clash_api("GET", "/proxies/main-out", timeout=1) or {}).get("now")
+            except Exception: now=None
+            now=now or state_load().get("last_node_tag") or ob.get("default")
+            ob = next((o for o in cfg.get("outbounds",[]) if o.get("tag")==now), ob)
+            if ob.get("type")=="urltest":
+                # urltest 组：再取组内当前选中的节点
+                try: now=(clash_api("GET", f"/proxies/{urllib.parse.quote(ob['tag'])}", timeout=1) or {}).get("now")
+                except Exception: now=None
+                ob = next((o for o in cfg.get("outbounds",[]) if o.get("tag")==now), ob)
         server = ob.get("server")
         port   = ob.get("server_port")
         tag    = ob.get("tag") or "main-out"
         typ    = ob.get("type")
 
-        # 解析出 IPv4
-        ip = server
-        if isinstance(server, str) and server and not re.match(r'^\d{1,3}(\.\d{1,3}){3}$', server):
-            try:
-                infos = socket.getaddrinfo(server, port or 443, proto=socket.IPPROTO_TCP)
-                v4 = [ai[4][0] for ai in infos if ':' not in ai[4][0]]
-                ip = v4[0] if v4 else infos[0][4][0]
-            except Exception:
-                ip = None
+        # IP 取解析缓存，不在请求线程里等 DNS；还没有结果时 resolving=true，前端稍后再取
+        e = RESOLVER.peek(server, node_strategy(ob)) if isinstance(server, str) else None
+        ip = e["ips"][0] if e and e["ips"] else None
+        resolving = e is None
 
         # 从状态里取"订阅别名"
         st = state_load()
@@ -600,39 +2213,25 @@ def api_cfg_mainout():
 
         return jsonify(ok=True, msg="mainout",
                        node={"tag": tag, "alias": alias, "type": typ,
-                             "server": server, "server_port": port, "ip": ip})
+                             "server": server, "server_port": port, "ip": ip, "resolving": resolving})
     except Exception as e:
         return jsonify(ok=False, msg=f"read cfg fail: {e}")
  
 NET_IFACE = os.environ.get("SB_IFACE", "eth0")
-_CPU_LAST = {"total": None, "idle": None, "ts": None}
+METRICS_INTERVAL = float(os.environ.get("SB_METRICS_INTERVAL", "2"))
 
 # === 工具函数：CPU/温度/网卡字节 ===
-def _read_cpu_times():
-    # /proc/stat 第一行: cpu  user nice system idle iowait irq softirq steal guest guest_nice
+def _read_cpu_all():
+    """/proc/stat 的 cpu、cpu0、cpu1... 行 -> [(name,total,idle)]"""
+    out=[]
     with open("/proc/stat","r") as f:
-        line=f.readline()
-    parts=line.split()
-    if parts[0]!="cpu": return None,None
-    nums=list(map(int, parts[1:]))
-    idle=nums[3]+nums[4] if len(nums)>=5 else nums[3]  # idle + iowait
-    total=sum(nums)
-    return total,idle
-
-def cpu_usage_percent():
-    global _CPU_LAST
-    total,idle=_read_cpu_times()
-    if total is None: return None
-    now=time.time()
-    if _CPU_LAST["total"] is None:
-        _CPU_LAST.update({"total":total,"idle":idle,"ts":now})
-        return None
-    dt_total=total-_CPU_LAST["total"]
-    dt_idle =idle -_CPU_LAST["idle"]
-    _CPU_LAST.update({"total":total,"idle":idle,"ts":now})
-    if dt_total<=0: return None
-    usage=100.0*(dt_total-dt_idle)/dt_total
-    return round(usage,1)
+        for line in f:
+            if not line.startswith("cpu"): break
+            parts=line.split()
+            nums=list(map(int, parts[1:]))
+            idle=nums[3]+nums[4] if len(nums)>=5 else nums[3]  # idle + iowait
+            out.append((parts[0], sum(nums), idle))
+    return out
 
 def read_temperatures():
     temps=[]
@@ -660,21 +2259,1011 @@ def read_net_bytes(iface):
     except Exception:
         return None,None
 
+def list_net_ifaces():
+    try: names=sorted(x for x in os.listdir("/sys/class/net") if x!="lo")
+    except Exception: names=[]
+    if NET_IFACE not in names: names.insert(0, NET_IFACE)
+    return names[:8]
+
+# ====== 指标采样 + 多分辨率环形缓冲 ======
+# 采样线程每秒采一次，写入 1s/10s/1min 三档环形缓冲；SSE 推送与 /api/metrics 都读这里
+METRIC_RES = (("1s", 1, 600), ("10s", 10, 8640), ("1m", 60, 43200))   # (名称, 步长秒, 槽数)
+NAN = float("nan")
+
+class Ring:
+    """定长环形缓冲：每个序列一段预分配的 array('f')，按 时间//步长 取模定位槽位；
+    步长内的多次采样先累加，跨入下一个槽时写入平均值"""
+    def __init__(self, step:int, size:int, names:list):
+        self.step, self.size, self.names = step, size, list(names)
+        self.slot_t=array("d", [0.0])*size                    # 槽位对应的时间（步长对齐），0 表示空
+        self.data={n: array("f", [NAN])*size for n in self.names}
+        self.acc_t=None; self.acc_sum=[0.0]*len(self.names); self.acc_n=[0]*len(self.names)
+
+    def add(self, ts:float, values:list):
+        t=ts//self.step*self.step
+        if self.acc_t is not None and t!=self.acc_t: self._flush()
+        self.acc_t=t
+        for i,v in enumerate(values):
+            if v is not None: self.acc_sum[i]+=v; self.acc_n[i]+=1
+
+    def _flush(self):
+        idx=int(self.acc_t//self.step)%self.size
+        self.slot_t[idx]=self.acc_t
+        for i,n in enumerate(self.names):
+            self.data[n][idx]=self.acc_sum[i]/self.acc_n[i] if self.acc_n[i] else NAN
+            self.acc_sum[i]=0.0; self.acc_n[i]=0
+
+    def query(self, names:list, since:float, until:float, points:int):
+        """取 [since, until) 的数据并按平均降采样到最多 points 个点；缺数据为 None"""
+        first=int(since//self.step); last=int(until//self.step)
+        first=max(first, last-self.size+1)
+        n=last-first
+        if n<=0: return [], {k:[] for k in names}
+        per=max(1, -(-n//max(points,1)))         # 每个输出点合并的槽数（向上取整）
+        ts, out = [], {k:[] for k in names if k in self.data}
+        for b in range(first, last, per):
+            ts.append(b*self.step)
+            for k in out:
+                arr=self.data[k]; acc=0.0; cnt=0
+                for j in range(b, min(b+per, last)):
+                    idx=j%self.size
+                    if self.slot_t[idx]==j*self.step:
+                        v=arr[idx]
+                        if v==v: acc+=v; cnt+=1        # 跳过 NaN
+                out[k].append(round(acc/cnt,2) if cnt else None)
+        return ts, out
+
+_METRIC_SUBS = set()
+_METRIC_LOCK = threading.Lock()
+_METRIC_LAST = None
+_METRIC_THREAD = None
+_METRIC_RINGS = {}
+_METRIC_NAMES = []
+
+def metrics_sample(prev:dict, ifaces:list) -> dict:
+    """采一次样；prev 为上次的原始计数（就地更新），CPU 占用与速率在这里算好"""
+    ts=time.time()
+    cpus={}
+    for name,total,idle in _read_cpu_all():
+        p=prev.get(name)
+        cpus[name]=round(100.0*((total-p[0])-(idle-p[1]))/(total-p[0]),1) if p and total>p[0] else None
+        prev[name]=(total, idle)
+    temps=read_temperatures()
+    xs=[t["celsius"] for t in temps]
+    net={}
+    for ifc in ifaces:
+        rx,tx=read_net_bytes(ifc)
+        p=prev.get(("net",ifc))
+        if rx is not None and p and ts>p[2]:
+            dt=ts-p[2]; net[ifc]=(rx, tx, round(max(rx-p[0],0)/dt,1), round(max(tx-p[1],0)/dt,1))
+        else:
+            net[ifc]=(rx, tx, None, None)
+        prev[("net",ifc)]=(rx, tx, ts)
+    rx,tx,rx_rate,tx_rate=net.get(NET_IFACE, (None,None,None,None))
+    return {"ts":round(ts,3),"cpu":cpus.pop("cpu",None),"cores":list(cpus.values()),
+            "temp":round(sum(xs)/len(xs),1) if xs else None,"temps":temps,
+            "iface":NET_IFACE,"rx_bytes":rx,"tx_bytes":tx,"rx_Bps":rx_rate,"tx_Bps":tx_rate,
+            "net":{k:{"rx_Bps":v[2],"tx_Bps":v[3]} for k,v in net.items()}}
+
+def metrics_sampler(ifaces:list, ncores:int):
+    global _METRIC_LAST
+    prev={}; last_push=0.0
+    while True:
+        t0=time.time()
+        try:
+            sample=metrics_sample(prev, ifaces)
+            cores=(sample["cores"]+[None]*ncores)[:ncores]
+            row=[sample["cpu"]]+cores+[sample["temp"]]
+            for ifc in ifaces:
+                r=sample["net"][ifc]; row+=[r["rx_Bps"], r["tx_Bps"]]
+            with _METRIC_LOCK:
+                for ring in _METRIC_RINGS.values(): ring.add(sample["ts"], row)
+                _METRIC_LAST=sample
+                subs=list(_METRIC_SUBS) if sample["ts"]-last_push>=METRICS_INTERVAL-0.5 else []
+            if subs:
+                last_push=sample["ts"]
+                for q in subs:
+                    try: q.put_nowait(sample)
+                    except queue.Full: pass     # 客户端太慢，丢一帧
+        except Exception as e:
+            print(f"metrics: {e}")
+        time.sleep(max(0.05, 1.0-(time.time()-t0)))
+
+def metrics_start():
+    """启动采样线程（只启动一次），缓冲按 CPU 核数与网卡数一次性分配"""
+    global _METRIC_THREAD, _METRIC_NAMES
+    with _METRIC_LOCK:
+        if _METRIC_THREAD is not None: return
+        ifaces=list_net_ifaces()
+        ncores=max(0, len(_read_cpu_all())-1)
+        _METRIC_NAMES=["cpu"]+[f"cpu{i}" for i in range(ncores)]+["temp"]
+        for ifc in ifaces: _METRIC_NAMES+=[f"rx:{ifc}", f"tx:{ifc}"]
+        for name,step,size in METRIC_RES: _METRIC_RINGS[name]=Ring(step, size, _METRIC_NAMES)
+        _METRIC_THREAD=threading.Thread(target=metrics_sampler, args=(ifaces, ncores), name="metrics", daemon=True)
+        _METRIC_THREAD.start()
+
+def metrics_subscribe():
+    """新建订阅队列；已达 WEB_SSE_MAX 个订阅时返回 None"""
+    metrics_start()
+    q=queue.Queue(maxsize=8)
+    with _METRIC_LOCK:
+        if len(_METRIC_SUBS)>=WEB_SSE_MAX: return None
+        _METRIC_SUBS.add(q)
+    return q
+
+def metrics_unsubscribe(q):
+    with _METRIC_LOCK: _METRIC_SUBS.discard(q)
+
+def metrics_history(names:list, span:float, res:str="auto", points:int=300):
+    """最近 span 秒的历史；res=auto 时选能覆盖 span 的最细分辨率"""
+    metrics_start()
+    if res=="auto":
+        res=next((n for n,step,size in METRIC_RES if step*size>=span), METRIC_RES[-1][0])
+    ring=_METRIC_RINGS.get(res)
+    if ring is None: raise ValueError(f"未知分辨率: {res}")
+    names=[n for n in (names or ["cpu", "temp", f"rx:{NET_IFACE}", f"tx:{NET_IFACE}"]) if n in ring.data]
+    now=time.time()
+    with _METRIC_LOCK:
+        ts, series = ring.query(names, now-span, now, points)
+    return {"res":res,"step":ring.step,"t":ts,"series":series}
+
 # === 路由：/api/metrics ===
 @app.route("/api/metrics", methods=["POST"])
 def api_metrics():
     if not (TOKEN and request.headers.get("X-Token","")==TOKEN):
         return jsonify(ok=False, msg="Unauthorized"), 401
     try:
-        cpu=cpu_usage_percent()
-        temps=read_temperatures()
-        rx,tx=read_net_bytes(NET_IFACE)
+        metrics_start()
+        m=_METRIC_LAST or {}
         return jsonify(ok=True, msg="metrics",
-                       cpu={"usage": cpu},
-                       temps=temps,
-                       net={"iface": NET_IFACE, "rx_bytes": rx, "tx_bytes": tx, "ts": time.time()})
+                       cpu={"usage": m.get("cpu"), "cores": m.get("cores",[])},
+                       temps=m.get("temps",[]),
+                       net={"iface": NET_IFACE, "rx_bytes": m.get("rx_bytes"), "tx_bytes": m.get("tx_bytes"),
+                            "ts": m.get("ts", time.time())})
     except Exception as e:
         return jsonify(ok=False, msg=str(e)), 500
-    
+
+@app.route("/api/metrics/history", methods=["POST"])
+def api_metrics_history():
+    if not (TOKEN and request.headers.get("X-Token","")==TOKEN):
+        return jsonify(ok=False, msg="Unauthorized"), 401
+    data=request.get_json(force=True, silent=True) or {}
+    try:
+        h=metrics_history(data.get("series"), float(data.get("span",600)),
+                          data.get("res","auto"), min(int(data.get("points",300)), 2000))
+        return jsonify(ok=True, msg="history", series_names=_METRIC_NAMES, **h)
+    except ValueError as e:
+        return jsonify(ok=False, msg=str(e)), 400
+
+# ====== /metrics（OpenMetrics） ======
+def _cpu_rows():
+    m=_METRIC_LAST or {}
+    return [(("all",), m.get("cpu"))]+[((str(i),), v) for i,v in enumerate(m.get("cores") or [])]
+
+def _net_rows():
+    rows=[]
+    for ifc in list_net_ifaces():
+        rx,tx=read_net_bytes(ifc)
+        rows+=[((ifc,"rx"), rx), ((ifc,"tx"), tx)]
+    return rows
+
+Metric("sbweb_cpu_usage_percent", "gauge", "CPU 占用（采样线程最近一次）", ("cpu",), fn=_cpu_rows)
+Metric("sbweb_thermal_celsius", "gauge", "温度传感器", ("zone",),
+       fn=lambda: [((t["name"],), t["celsius"]) for t in read_temperatures()])
+Metric("sbweb_net_bytes_total", "counter", "网卡收发字节", ("iface","direction"), fn=_net_rows)
+Metric("sbweb_nodes", "gauge", "节点数", fn=lambda: [((), len(nodes_load()))])
+Metric("sbweb_dns_cache_entries", "gauge", "域名解析缓存条目", fn=lambda: [((), RESOLVER.stats()["entries"])])
+
+@app.before_request
+def _http_t0():
+    request.environ["sbweb.t0"]=time.perf_counter()
+
+@app.after_request
+def _http_observe(resp):
+    t0=request.environ.get("sbweb.t0")
+    if t0 is not None:
+        ep=request.endpoint or "other"
+        M_HTTP_SECONDS.observe(M_HTTP_SECONDS.labels(ep), time.perf_counter()-t0)
+        M_HTTP_TOTAL.inc(M_HTTP_TOTAL.labels(ep, resp.status_code))
+    return resp
+
+@app.route("/metrics")
+def metrics_export():
+    if not METRICS_PUBLIC:
+        tok=request.headers.get("X-Token") or request.args.get("token","")
+        auth=request.headers.get("Authorization","")
+        if auth.startswith("Bearer "): tok=auth[7:]
+        if not (TOKEN and tok==TOKEN): return Response("unauthorized\n", status=401, mimetype="text/plain")
+    metrics_start()
+    return Response(metrics_render(), content_type="application/openmetrics-text; version=1.0.0; charset=utf-8")
+
+# ====== 指标推送（SSE） ======
+@app.route("/api/metrics/stream")
+def api_metrics_stream():
+    # EventSource 不能带自定义请求头，令牌也可放在查询参数里
+    if not (TOKEN and (request.headers.get("X-Token") or request.args.get("token",""))==TOKEN):
+        return jsonify(ok=False, msg="Unauthorized"), 401
+    q=metrics_subscribe()
+    if q is None:     # EventSource 首次连接即失败时页面退回轮询
+        return jsonify(ok=False, msg="推送连接已满，请改用轮询"), 503, {"Retry-After":"30"}
+    def gen():
+        last={}
+        try:
+            yield "retry: 3000\n\n"
+            while not _SHUTDOWN.is_set():
+                try: sample=q.get(timeout=5)
+                except queue.Empty:
+                    yield ": ping\n\n"; continue
+                # 只发送变化的字段，首帧为全量
+                delta={k:v for k,v in sample.items() if k not in last or last[k]!=v}
+                last=sample
+                yield f"data: {json.dumps(delta, ensure_ascii=False, separators=(',',':'))}\n\n"
+        finally:
+            metrics_unsubscribe(q)
+    return Response(gen(), mimetype="text/event-stream",
+                    headers={"Cache-Control":"no-cache","X-Accel-Buffering":"no"})
+
+# ====== 自动择优 / 故障切换 ======
+_FAILOVER_STOP = threading.Event()
+
+def failover_enabled(st:dict) -> bool:
+    return st.get("failover_enabled", FAILOVER)
+
+def url_delay(tag:str, timeout_ms=5000):
+    """经 Clash API 让指定出站请求 FAILOVER_URL（期望 204），返回毫秒；失败返回 None"""
+    q=urllib.parse.urlencode({"url":FAILOVER_URL,"timeout":timeout_ms})
+    try:
+        r=clash_api("GET", f"/proxies/{urllib.parse.quote(tag)}/delay?{q}", timeout=timeout_ms/1000+1)
+        return (r or {}).get("delay") or None
+    except Exception:
+        return None
+
+def measure_node(ob:dict, probe:dict, via_tag:str=None) -> dict:
+    """评分一律取 TCP+TLS 建连耗时，当前节点和候选才可比；via_tag 可经 Clash API 测 HTTP 204 时延，只用来判断通不通"""
+    m={"tag":ob.get("tag"),"ok":probe["ok"],"tcp_ms":probe["tcp_ms"],"tls_ms":probe["tls_ms"],"http_ms":None}
+    if via_tag and m["ok"]:
+        m["http_ms"]=url_delay(via_tag)
+        if m["http_ms"] is None: m["ok"]=False
+    m["score"]=probe["latency_ms"] if m["ok"] else None
+    return m
+
+def failover_round() -> dict:
+    """检测一轮：当前节点劣化（连续 FAILOVER_ROUNDS 轮）且有明显更好的候选时切换"""
+    st=state_load(); fo=st.get("failover") or {}
+    nodes=nodes_load()
+    last=st.get("last_node_tag","")
+    cur,_=node_by_tag(last)
+    if cur is None: return {"action":"skip","reason":"当前节点不在节点列表中"}
+    # Clash API 可用时额外经 HTTP 204 确认节点真的能用（不参与打分）
+    try: api_up=clash_api("GET", "/version", timeout=1) is not None
+    except Exception: api_up=False
+    fast_tags=set((st.get("fast_switch") or {}).get("tags",[])) if api_up else set()
+    # 候选：按缓存的延迟取前 FAILOVER_POOL 个（没测过的排在后面）
+    def cached_lat(i):
+        r=probe_cached(nodes[i], True) or probe_cached(nodes[i])
+        return r["latency_ms"] if r and r["ok"] and r["latency_ms"] is not None else float("inf")
+    cands=sorted((i for i in range(len(nodes)) if i!=cur and nodes[i].get("type") not in UDP_TYPES), key=cached_lat)
+    cands=cands[:FAILOVER_POOL]
+    probes=probe_nodes([nodes[i] for i in [cur]+cands], tls=True, force=True)
+    active=measure_node(nodes[cur], probes[0], "main-out" if api_up else None)
+    scored=[]
+    for i,p in zip(cands, probes[1:]):
+        m=measure_node(nodes[i], p, nodes[i]["tag"] if nodes[i]["tag"] in fast_tags else None)
+        if m["ok"] and m["score"] is not None: scored.append((m["score"], i, m))
+    scored.sort(key=lambda x:(x[0], x[1]))
+    degraded=(not active["ok"]) or (active["score"] or 0)>FAILOVER_MAX_MS
+    fo["bad_rounds"]=fo.get("bad_rounds",0)+1 if degraded else 0
+    now=time.time()
+    entry={"ts":now,"active":last,"score":active["score"],"ok":active["ok"],"action":"keep","to":None,"reason":""}
+    if degraded and scored:
+        best_score, best, bm = scored[0]
+        held=now-fo.get("last_switch",0)<FAILOVER_HOLD and active["ok"]   # 节点彻底不通时不受间隔限制
+        better=(not active["ok"]) or best_score<active["score"]*(1-FAILOVER_MARGIN)
+        if fo["bad_rounds"]<FAILOVER_ROUNDS:
+            entry.update(action="degraded", reason=f"劣化 {fo['bad_rounds']}/{FAILOVER_ROUNDS} 轮")
+        elif held:
+            entry.update(action="degraded", reason="距上次切换过近")
+        elif not better:
+            entry.update(action="degraded", reason="无明显更优候选")
+        else:
+            r=apply_node(best)
+            entry.update(action="switch" if r["ok"] else "switch_failed", to=nodes[best]["tag"],
+                         reason=r["msg"], to_score=best_score)
+            if r["ok"]:
+                fo["last_switch"]=now; fo["bad_rounds"]=0
+    elif degraded:
+        entry.update(action="degraded", reason="没有可用候选")
+    fo["log"]=(fo.get("log") or [])[-49:]+[entry]
+    fo["last_check"]=now
+    state_update(failover=fo)     # 探测期间别处可能改过状态（切换节点、拉订阅……），只写自己的键
+    return entry
+
+def failover_loop():
+    while not _FAILOVER_STOP.wait(FAILOVER_INTERVAL):
+        try:
+            if failover_enabled(state_load()): failover_round()
+        except Exception as e:
+            print(f"failover: {e}")
+
+@app.route("/api/failover", methods=["POST"])
+def api_failover():
+    ok_auth, resp = must_auth()
+    if not ok_auth: return resp
+    data=request.get_json(force=True, silent=True) or {}
+    if "enabled" in data: state_update(failover_enabled=bool(data["enabled"]))
+    if data.get("run"): failover_round()
+    st=state_load(); fo=st.get("failover") or {}
+    return ok("failover", enabled=failover_enabled(st), interval=FAILOVER_INTERVAL,
+              last_switch=fo.get("last_switch"), bad_rounds=fo.get("bad_rounds",0), log=fo.get("log",[]))
+
+# ====== 吞吐测速 ======
+# 每个被测节点起一个临时 sing-box：mixed 入站监听 127.0.0.1 的空闲端口，出站就是该节点（带 bind_interface，
+# 不会被网关自己的 tun 截获）。经 HTTP 代理下载 SPEED_DOWN_URL、上传到 SPEED_UP_URL，按有效字节/耗时算 Mbps。
+# 得分按 node_key 记在 SPEED_FILE：新结果与旧分按时间衰减加权（半衰期 SPEED_HALFLIFE），失败记 0
+SPEED_ALPHA = 0.3       # 新结果的最小权重
+_SPEED = {"loaded":False, "scores":{}, "version":0}
+_SPEED_LOCK = threading.Lock()
+_SPEED_SEM  = threading.Semaphore(max(1, SPEED_CONCURRENCY))
+M_SPEED_BYTES = Metric("sbweb_speedtest_bytes_total", "counter", "测速消耗的流量", ("direction",))
+
+def speed_scores() -> dict:
+    with _SPEED_LOCK:
+        if not _SPEED["loaded"]:
+            _SPEED["loaded"]=True
+            try: _SPEED["scores"]=json.load(open(SPEED_FILE)).get("scores",{})
+            except Exception: pass
+        return _SPEED["scores"]
+
+def speed_record(ob:dict, down, up, error=None):
+    """记一次结果（Mbps；失败时 down/up 为 0）"""
+    now=time.time(); k=node_key(ob)
+    scores=speed_scores()
+    with _SPEED_LOCK:
+        e=scores.get(k)
+        if e is None:
+            e=scores[k]={"down":down,"up":up,"n":0}
+        else:
+            a=max(SPEED_ALPHA, 1-0.5**((now-e["ts"])/SPEED_HALFLIFE))
+            for f,x in (("down",down),("up",up)):
+                if x is None: continue
+                e[f]=x if e.get(f) is None else round(e[f]*(1-a)+x*a, 2)
+        e.update(ts=now, n=e["n"]+1, tag=ob.get("tag"), last={"down":down,"up":up,"error":error,"ts":now})
+        _SPEED["version"]+=1
+        _atomic_write(SPEED_FILE, _dumps({"scores":scores}))
+
+def speed_of(ob:dict):
+    """节点当前的下载得分（Mbps）；没测过返回 None"""
+    e=speed_scores().get(node_key(ob))
+    return e.get("down") if e else None
+
+class SpeedBudget:
+    """任务内共享的流量额度（多个测速线程一起扣）"""
+    def __init__(self, total:int):
+        self.total=self.left=total; self.lock=threading.Lock()
+    def take(self, n:int) -> int:
+        """申请至多 n 字节，返回实际批到的"""
+        with self.lock:
+            n=max(0, min(n, self.left)); self.left-=n; return n
+    def give(self, n:int):
+        with self.lock: self.left+=n
+    @property
+    def used(self): return self.total-self.left
+
+def _free_port() -> int:
+    with socket.socket() as so:
+        so.bind(("127.0.0.1", 0)); return so.getsockname()[1]
+
+def speed_config(ob:dict, port:int) -> dict:
+    """临时 sing-box 配置：mixed 入站 -> 被测节点；域名解析沿用主配置里 resolver 那台 DNS"""
+    out=dict(outbound_of(ob), tag="speed-out")
+    cfg={"log":{"level":"error"},
+         "inbounds":[{"type":"mixed","tag":"speed-in","listen":"127.0.0.1","listen_port":port}],
+         "outbounds":[out, {"type":"direct","tag":"direct"}],
+         "route":{"final":"speed-out"}}
+    rt=(out.get("domain_resolver") or {}).get("server")
+    srv=next((dict(x) for x in (cfg_load().get("dns") or {}).get("servers",[]) if x.get("tag")==rt), None) if rt else None
+    if srv:
+        if srv.get("detour") not in (None, "direct"): srv.pop("detour")
+        cfg["dns"]={"servers":[srv],"final":rt}
+    elif rt:
+        out.pop("domain_resolver", None)
+    return cfg
+
+def _wait_port(port:int, proc, timeout=5.0) -> bool:
+    deadline=time.time()+timeout
+    while time.time()<deadline and proc.poll() is None:
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=0.2): return True
+        except OSError: time.sleep(0.05)
+    return False
+
+def _speed_down(opener, url:str, limit:int, budget:SpeedBudget) -> (int, float):
+    """下载至多 limit 字节（已从额度中申请）或 SPEED_TIMEOUT 秒；返回 (字节数, 秒)，从收到首字节开始计时"""
+    got=0; t0=None; deadline=time.time()+SPEED_TIMEOUT
+    try:
+        with opener.open(url.replace("{bytes}", str(limit)), timeout=SPEED_TIMEOUT) as r:
+            while got<limit and time.time()<deadline:
+                b=r.read(min(65536, limit-got))
+                if not b: break
+                if t0 is None: t0=time.perf_counter()
+                got+=len(b)
+    finally:
+        budget.give(limit-got)        # 没用完的额度退回
+        M_SPEED_BYTES.inc(M_SPEED_BYTES.labels("down"), got)
+    return got, (time.perf_counter()-t0) if t0 else 0.0
+
+def _speed_up(opener, url:str, size:int, budget:SpeedBudget) -> (int, float):
+    size=budget.take(size)
+    if not size: return 0, 0.0
+    chunk=b"\0"*65536; t0=[None]
+    def body():
+        left=size
+        t0[0]=time.perf_counter()     # 与下载一致：从开始发正文算起，不含建连 / 握手
+        while left>0:
+            n=min(left, len(chunk)); left-=n; yield chunk[:n]
+    req=urllib.request.Request(url, data=body(), method="POST",
+                               headers={"Content-Type":"application/octet-stream","Content-Length":str(size)})
+    try:
+        with opener.open(req, timeout=SPEED_TIMEOUT) as r: r.read()
+    except Exception:
+        budget.give(size); raise
+    M_SPEED_BYTES.inc(M_SPEED_BYTES.labels("up"), size)
+    return size, (time.perf_counter()-t0[0]) if t0[0] else 0.0
+
+def speed_one(ob:dict, budget:SpeedBudget, down_bytes:int, up_bytes:int) -> dict:
+    """测一个节点；申请不到下载额度时跳过。只有临时代理起来之后、下载/上传本身失败才记 0 分，
+    本机的问题（SB_BIN 缺失、临时 sing-box 起不来、端口被抢）只返回错误，不影响历史得分"""
+    res={"tag":ob.get("tag"),"ok":False,"skipped":False,"down_mbps":None,"up_mbps":None,"down_bytes":0,"up_bytes":0,"error":None}
+    with _SPEED_SEM:
+        grant=budget.take(down_bytes)     # 检查与扣减一步完成，不会出现“看着有额度、实际拿到 0”
+        if not grant:
+            res.update(skipped=True, error="skipped: budget")
+            return res
+        proc=tmp=None; proxied=False
+        try:
+            port=_free_port()
+            tmp=tempfile.NamedTemporaryFile("w", suffix=".json", prefix="sb-speed-", delete=False)
+            with tmp: json.dump(speed_config(ob, port), tmp)
+            proc=subprocess.Popen([SB_BIN, "run", "-c", tmp.name], stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+            if not _wait_port(port, proc):
+                raise RuntimeError("临时 sing-box 未能启动: "+(proc.stderr.read(300).decode("utf-8","ignore").strip() if proc.poll() is not None else "超时"))
+            proxied=True
+            proxy=f"http://127.0.0.1:{port}"
+            opener=urllib.request.build_opener(urllib.request.ProxyHandler({"http":proxy,"https":proxy}))
+            g, grant = grant, 0       # 交给 _speed_down，由它退回没用完的部分
+            n, dt = _speed_down(opener, SPEED_DOWN_URL, g, budget)
+            res["down_bytes"]=n
+            if n and dt>0: res["down_mbps"]=round(n*8/dt/1e6, 2)
+            if up_bytes and SPEED_UP_URL:
+                n, dt = _speed_up(opener, SPEED_UP_URL, up_bytes, budget)
+                res["up_bytes"]=n
+                if n and dt>0: res["up_mbps"]=round(n*8/dt/1e6, 2)
+            res["ok"]=res["down_mbps"] is not None
+            if not res["ok"]: res["error"]="没有收到数据"
+        except Exception as e:
+            res["error"]=str(e) or e.__class__.__name__
+        finally:
+            if grant: budget.give(grant)   # 没走到下载（如临时 sing-box 没起来）
+            if proc is not None and proc.poll() is None:
+                proc.terminate()
+                try: proc.wait(timeout=3)
+                except subprocess.TimeoutExpired: proc.kill()
+            if proc is not None and proc.stderr: proc.stderr.close()
+            if tmp is not None: os.unlink(tmp.name)
+    if not proxied: return res
+    speed_record(ob, res["down_mbps"] or 0.0, res["up_mbps"] if res["ok"] else (0.0 if up_bytes else None), res["error"])
+    return res
+
+def speed_targets(data:dict) -> list:
+    """请求 -> 被测节点下标：idxs / index，或 target=main-out（当前节点）"""
+    nodes=nodes_load()
+    if data.get("target")=="main-out":
+        tag="main-out"
+        for _ in range(3):       # main-out -> auto(urltest) -> 节点
+            try: tag=(clash_api("GET", f"/proxies/{urllib.parse.quote(tag)}", timeout=1) or {}).get("now") or ""
+            except Exception: tag=""
+            if not tag or node_by_tag(tag)[0] is not None: break
+        i,_=node_by_tag(tag) if tag else (None, None)
+        if i is None: i,_=node_by_tag(state_load().get("last_node_tag",""))
+        return [i] if i is not None else []
+    idxs=data.get("idxs")
+    if idxs is None and data.get("index") is not None: idxs=[data["index"]]
+    return [int(i) for i in (idxs or []) if 0<=int(i)<len(nodes)]
+
+def speed_test(idxs:list, down_bytes:int=SPEED_DOWN_BYTES, up_bytes:int=SPEED_UP_BYTES) -> dict:
+    """测速任务：并发不超过 SPEED_CONCURRENCY，总流量不超过 SPEED_MAX_BYTES"""
+    nodes=nodes_load()
+    iface=get_system_interface()
+    obs=[inject_iface(dict(nodes[i]), iface) for i in idxs]
+    budget=SpeedBudget(SPEED_MAX_BYTES); results=[None]*len(obs); done=[0]
+    job_progress(done=0, total=len(obs), bytes=0)
+    job=getattr(_JOB_LOCAL, "job", None)
+    def one(k):
+        results[k]=speed_one(obs[k], budget, down_bytes, up_bytes)
+        done[0]+=1
+        if job is not None:
+            job["progress"]={"done":done[0],"total":len(obs),"bytes":budget.used,"current":obs[k].get("tag")}
+    with ThreadPoolExecutor(max_workers=max(1, SPEED_CONCURRENCY), thread_name_prefix="speed") as pool:
+        list(pool.map(one, range(len(obs))))
+    for i,r in zip(idxs, results): r["idx"]=i
+    good=sum(1 for r in results if r.get("ok")); skipped=sum(1 for r in results if r.get("skipped"))
+    return {"ok":good>0,"msg":f"测速完成：{good}/{len(results)} 个节点成功"+(f"，{skipped} 个因流量上限跳过" if skipped else ""),
+            "results":results,
+            "bytes":budget.used}
+
+@app.route("/api/speedtest", methods=["POST"])
+def api_speedtest():
+    """{"idxs":[..]} / {"index":n} / {"target":"main-out"}，可选 down_bytes/up_bytes；总是作为后台任务运行"""
+    ok_auth, resp = must_auth()
+    if not ok_auth: return resp
+    data=request.get_json(force=True, silent=True) or {}
+    idxs=speed_targets(data)
+    if not idxs: return err("没有可测的节点")
+    down=max(1, min(int(data.get("down_bytes") or SPEED_DOWN_BYTES), SPEED_MAX_BYTES))
+    up=max(0, min(int(data.get("up_bytes") if data.get("up_bytes") is not None else SPEED_UP_BYTES), SPEED_MAX_BYTES))
+    return ok("已提交", job=job_submit("speed", speed_test, idxs, down, up), count=len(idxs))
+
+# ====== 流量统计 ======
+# 定时取 Clash API 的 /connections 快照，按连接 id 求增量后累加到各维度计数器：
+#   outbound: 路由选中的出站（main-out/direct...）  node: 实际节点  rule: 命中的规则  client: LAN 源 IP
+TRAFFIC_DIMS = ("outbound", "node", "rule", "client")
+TRAFFIC_MAX_KEYS = 4096
+_TRAFFIC = {d:{} for d in TRAFFIC_DIMS}      # 维度 -> {名称: [上行字节, 下行字节, 连接数]}
+_TRAFFIC_ACTIVE = {d:{} for d in TRAFFIC_DIMS}
+_TRAFFIC_HOURS = {}                           # 小时起点 -> {出站: [上行, 下行]}
+_TRAFFIC_META = {"since": time.time(), "last_poll": None, "error": None, "loaded": False}
+_TRAFFIC_LOCK = threading.Lock()
+
+def _conn_dims(c:dict):
+    chains=c.get("chains") or []
+    md=c.get("metadata") or {}
+    return (chains[-1] if chains else "?", chains[0] if chains else "?",
+            (c.get("rule") or "?")[:120], md.get("sourceIP") or "?")
+
+def traffic_poll(prev:dict):
+    """处理一次连接快照；prev 为 连接id -> (上行, 下行)，就地更新"""
+    snap=clash_api("GET", "/connections", timeout=3) or {}
+    seen={}; active={d:{} for d in TRAFFIC_DIMS}
+    with _TRAFFIC_LOCK:
+        hour=_TRAFFIC_HOURS.setdefault(int(time.time()//3600*3600), {})
+        for c in snap.get("connections") or []:
+            cid=c.get("id"); up=int(c.get("upload") or 0); down=int(c.get("download") or 0)
+            p=prev.get(cid); seen[cid]=(up, down)
+            du, dd = (up-p[0], down-p[1]) if p else (up, down)
+            dims=_conn_dims(c)
+            for d,name in zip(TRAFFIC_DIMS, dims):
+                ctr=_TRAFFIC[d].get(name)
+                if ctr is None: ctr=_TRAFFIC[d][name]=[0,0,0]
+                ctr[0]+=max(du,0); ctr[1]+=max(dd,0)
+                if not p: ctr[2]+=1
+                active[d][name]=active[d].get(name,0)+1
+            h=hour.get(dims[0])
+            if h is None: h=hour[dims[0]]=[0,0]
+            h[0]+=max(du,0); h[1]+=max(dd,0)
+        _TRAFFIC_ACTIVE.update(active)
+        _TRAFFIC_META.update(last_poll=time.time(), error=None)
+    prev.clear(); prev.update(seen)
+
+def traffic_top(by:str, n:int=10, key:str="total"):
+    idx={"up":lambda v:v[0],"down":lambda v:v[1],"conns":lambda v:v[2],"total":lambda v:v[0]+v[1]}[key]
+    with _TRAFFIC_LOCK:
+        act=_TRAFFIC_ACTIVE.get(by,{})
+        rows=sorted(_TRAFFIC[by].items(), key=lambda kv:idx(kv[1]), reverse=True)[:n]
+        return [{"name":k,"up":v[0],"down":v[1],"conns":v[2],"active":act.get(k,0)} for k,v in rows]
+
+def traffic_load():
+    _TRAFFIC_META["loaded"]=True
+    try: data=json.load(open(TRAFFIC_FILE))
+    except Exception: return
+    with _TRAFFIC_LOCK:
+        for d in TRAFFIC_DIMS: _TRAFFIC[d].update(data.get("totals",{}).get(d,{}))
+        _TRAFFIC_HOURS.update({int(k):v for k,v in data.get("hours",{}).items()})
+        _TRAFFIC_META["since"]=data.get("since", _TRAFFIC_META["since"])
+
+def traffic_save():
+    """落盘：累计计数 + 最近 7 天的小时汇总；各维度只保留流量最大的 TRAFFIC_MAX_KEYS 项"""
+    if not _TRAFFIC_META["loaded"]: return     # 还没读入旧数据，不能覆盖
+    with _TRAFFIC_LOCK:
+        for d in TRAFFIC_DIMS:
+            if len(_TRAFFIC[d])>TRAFFIC_MAX_KEYS:
+                keep=sorted(_TRAFFIC[d].items(), key=lambda kv:kv[1][0]+kv[1][1], reverse=True)[:TRAFFIC_MAX_KEYS]
+                _TRAFFIC[d]=dict(keep)
+        for h in sorted(_TRAFFIC_HOURS)[:-168]: del _TRAFFIC_HOURS[h]
+        data={"since":_TRAFFIC_META["since"],"ts":time.time(),"totals":_TRAFFIC,"hours":_TRAFFIC_HOURS}
+        raw=json.dumps(data, ensure_ascii=False, separators=(",",":"))
+    os.makedirs(os.path.dirname(TRAFFIC_FILE), exist_ok=True)
+    tmp=TRAFFIC_FILE+".tmp"; open(tmp,"w").write(raw); os.replace(tmp, TRAFFIC_FILE)
+
+def traffic_loop():
+    traffic_load()
+    prev={}; last_save=time.time(); delay=TRAFFIC_INTERVAL
+    while True:
+        time.sleep(delay)
+        try:
+            traffic_poll(prev); delay=TRAFFIC_INTERVAL
+        except Exception as e:
+            # sing-box 未运行或未开 Clash API：退避，不刷日志。prev 保留，下次快照到来时由 traffic_poll 整体替换
+            # （sing-box 重启后连接 id 都会变，不会误算差值）
+            delay=min(delay*2, 60)
+            with _TRAFFIC_LOCK: _TRAFFIC_META["error"]=str(e)
+        if time.time()-last_save>=TRAFFIC_ROLLUP:
+            try: traffic_save()
+            except Exception as e: print(f"traffic: {e}")
+            last_save=time.time()
+
+@app.route("/api/traffic/top", methods=["POST"])
+def api_traffic_top():
+    ok_auth, resp = must_auth()
+    if not ok_auth: return resp
+    data=request.get_json(force=True, silent=True) or {}
+    by=data.get("by","outbound"); key=data.get("sort","total")
+    if by not in TRAFFIC_DIMS: return err(f"by 须为 {'/'.join(TRAFFIC_DIMS)}")
+    if key not in ("total","up","down","conns"): return err("sort 须为 total/up/down/conns")
+    with _TRAFFIC_LOCK: meta=dict(_TRAFFIC_META)
+    return ok("traffic", by=by, top=traffic_top(by, min(int(data.get("n",10)),200), key), **meta)
+
+@app.route("/api/traffic/hours", methods=["POST"])
+def api_traffic_hours():
+    ok_auth, resp = must_auth()
+    if not ok_auth: return resp
+    with _TRAFFIC_LOCK:
+        hours=[{"ts":h,"outbounds":{k:{"up":v[0],"down":v[1]} for k,v in _TRAFFIC_HOURS[h].items()}}
+               for h in sorted(_TRAFFIC_HOURS)]
+    return ok("traffic hours", hours=hours)
+
+@app.route("/api/traffic/reset", methods=["POST"])
+def api_traffic_reset():
+    ok_auth, resp = must_auth()
+    if not ok_auth: return resp
+    with _TRAFFIC_LOCK:
+        for d in TRAFFIC_DIMS: _TRAFFIC[d].clear()
+        _TRAFFIC_HOURS.clear(); _TRAFFIC_META["since"]=time.time()
+    traffic_save()
+    return ok("已清零")
+
+# ====== 规则集缓存 ======
+# 配置里 type=remote 的 rule_set 由这里下载（If-None-Match / If-Modified-Since），先写临时文件 fsync 再 rename；
+# 下载成功后把配置改为 type=local 指向本地文件。原始 URL 记在状态的 rulesets 里（sing-box 不接受多余字段）
+M_RULESET_TOTAL = Metric("sbweb_ruleset_fetch_total", "counter", "规则集下载次数", ("result",))
+_RULESET_LOCK = threading.Lock()
+SRS_MAGIC = b"SRS"
+
+def ruleset_path(tag:str, fmt:str="binary") -> str:
+    name=re.sub(r"[^A-Za-z0-9_.-]+","_", tag) or "ruleset"
+    return os.path.join(RULESET_DIR, f"{name}.{'srs' if fmt=='binary' else 'json'}")
+
+def ruleset_sources(cfg:dict, st:dict) -> list:
+    """需要管理的规则集：配置中的 remote 项，以及之前由这里改成 local 的项（URL 取自状态）"""
+    known=st.get("rulesets") or {}
+    out=[]
+    for rs in (cfg.get("route") or {}).get("rule_set") or []:
+        tag=rs.get("tag")
+        if rs.get("type")=="remote" and rs.get("url"):
+            out.append({"tag":tag,"url":rs["url"],"format":rs.get("format","binary"),
+                        "detour":rs.get("download_detour"),"interval":rs.get("update_interval")})
+        elif rs.get("type")=="local" and tag in known and known[tag].get("url") and rs.get("path")==known[tag].get("path"):
+            k=known[tag]
+            out.append({"tag":tag,"url":k["url"],"format":rs.get("format","binary"),
+                        "detour":k.get("detour"),"interval":k.get("interval")})
+    return out
+
+def ruleset_fetch(src:dict, cache:dict, force=False) -> dict:
+    """下载单个规则集。返回新的状态项 {"url","path","etag","last_modified","digest","size","ts","checked","error"}"""
+    path=ruleset_path(src["tag"], src["format"])
+    e=dict(cache, url=src["url"], path=path, format=src["format"], detour=src["detour"],
+           interval=src["interval"], checked=time.time(), error=None)
+    have=os.path.exists(path)
+    try:
+        status, v, body = http_fetch(src["url"], {} if (force or not have) else cache, timeout=SUB_TIMEOUT)
+        if status==304 or (have and v.get("digest")==cache.get("digest")):
+            if body: body.close()
+            M_RULESET_TOTAL.inc(M_RULESET_TOTAL.labels("unchanged"))
+            e.update({k:v.get(k) or cache.get(k) for k in ("etag","last_modified")})
+            return e
+        with body:
+            head=body.read(len(SRS_MAGIC)); body.seek(0)
+            if src["format"]=="binary" and head!=SRS_MAGIC:
+                raise ValueError("不是 sing-box 二进制规则集（.srs）")
+            if not v["size"]: raise ValueError("空文件")
+            os.makedirs(RULESET_DIR, exist_ok=True)
+            tmp=path+".tmp"
+            with open(tmp,"wb") as f:
+                for b in iter_file(body): f.write(b)
+                f.flush(); os.fsync(f.fileno())
+            os.replace(tmp, path)
+        e.update(etag=v.get("etag"), last_modified=v.get("last_modified"), digest=v["digest"], size=v["size"], ts=time.time())
+        M_RULESET_TOTAL.inc(M_RULESET_TOTAL.labels("updated"))
+    except Exception as ex:
+        e["error"]=str(ex) or ex.__class__.__name__
+        M_RULESET_TOTAL.inc(M_RULESET_TOTAL.labels("error"))
+    return e
+
+def ruleset_render(cfg:dict, st:dict, local:bool) -> dict:
+    """按状态把 rule_set 改成 local（有本地文件的）或还原成 remote；返回新配置，无变化时返回 None"""
+    known=st.get("rulesets") or {}
+    route=cfg.get("route") or {}
+    out, changed = [], False
+    for rs in route.get("rule_set") or []:
+        k=known.get(rs.get("tag"))
+        if k and local and rs.get("type")=="remote" and rs.get("url")==k.get("url") and os.path.exists(k["path"]):
+            rs={"tag":rs["tag"],"type":"local","format":rs.get("format","binary"),"path":k["path"]}; changed=True
+        elif k and not local and rs.get("type")=="local" and rs.get("path")==k.get("path"):
+            rs={"tag":rs["tag"],"type":"remote","format":rs.get("format","binary"),"url":k["url"]}
+            if k.get("detour"):   rs["download_detour"]=k["detour"]
+            if k.get("interval"): rs["update_interval"]=k["interval"]
+            changed=True
+        out.append(rs)
+    if not changed: return None
+    cfg=cfg_editable(); cfg["route"]["rule_set"]=out
+    return cfg
+
+def ruleset_sync(force=False, local=None) -> dict:
+    """并发下载全部规则集，然后按 local（默认 RULESET_LOCAL）改写配置。返回 {"ok","msg","rulesets","config"}"""
+    local=RULESET_LOCAL if local is None else local
+    with _RULESET_LOCK:
+        st=state_load(); known=st.get("rulesets") or {}
+        srcs=ruleset_sources(cfg_load(), st)
+        if local:
+            futs=[_SUB_POOL.submit(ruleset_fetch, src, known.get(src["tag"],{}), force) for src in srcs]
+            for src,f in zip(srcs, futs): known[src["tag"]]=f.result()
+        st=state_load(); st["rulesets"]=known; state_save(st)
+        cfg="unchanged"
+        with _APPLY_LOCK:     # 与切换节点 / 批量应用共用 SB_CFG.new，读-改-写要串行
+            new=ruleset_render(cfg_load(), st, local)
+            if new is not None:
+                ok1, out1, err1 = cfg_write_checked(new)
+                cfg="written" if ok1 else f"check failed: {err1.strip()[-300:]}"
+        bad=[t for t,e in known.items() if e.get("error")]
+        msg=f"{len(srcs)} 个规则集" + (f"，{len(bad)} 个下载失败" if bad else "") + \
+            ("，配置已改为本地文件" if local and cfg=="written" else "，配置已还原为远程" if cfg=="written" else "")
+        return {"ok":not cfg.startswith("check failed"),"msg":msg,"rulesets":known,"config":cfg}
+
+def ruleset_loop():
+    if RULESET_INTERVAL<=0: return
+    delay=5
+    while not _SHUTDOWN.wait(delay):
+        try: ruleset_sync()
+        except Exception as e: print(f"ruleset: {e}")
+        delay=RULESET_INTERVAL
+
+@app.route("/api/rulesets", methods=["POST"])
+def api_rulesets():
+    """{"sync":true,"force":false,"local":true,"async":false}；不带 sync 时只返回状态"""
+    ok_auth, resp = must_auth()
+    if not ok_auth: return resp
+    data=request.get_json(force=True, silent=True) or {}
+    if data.get("sync") or "local" in data:
+        args=(bool(data.get("force")), data["local"] if "local" in data else None)
+        if data.get("async"): return ok("已提交", job=job_submit("ruleset", ruleset_sync, *args))
+        return respond(ruleset_sync(*args))
+    st=state_load()
+    types={rs.get("tag"):rs.get("type") for rs in (cfg_load().get("route") or {}).get("rule_set") or []}
+    return ok("rulesets", rulesets=st.get("rulesets") or {}, types=types, dir=RULESET_DIR, interval=RULESET_INTERVAL)
+
+# ====== DNS 统计与缓存设置 ======
+# sing-box 的 debug 日志里每条查询都带 "[连接id 已耗时]" 前缀：
+#   dns: exchange <问题> via <server> / dns: exchanged ... / dns: exchange failed for ... / dns: cached ...
+# 同一 id 的 exchanged 减去 exchange 的耗时即上游耗时；cached 计一次命中，exchange 计一次未命中
+_DNS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+M_DNS_QUERIES  = Metric("sbweb_dns_cache_total", "counter", "sing-box DNS 缓存命中/未命中", ("result",))
+M_DNS_EXCHANGE = Metric("sbweb_dns_exchange_total", "counter", "上游 DNS 查询次数", ("server","result"))
+M_DNS_SECONDS  = Metric("sbweb_dns_exchange_seconds", "histogram", "上游 DNS 查询耗时", ("server",), _DNS_BUCKETS)
+M_DNS_PROBE    = Metric("sbweb_dns_probe_seconds", "histogram", "经 Clash API /dns/query 的端到端解析耗时", ("name",), _DNS_BUCKETS)
+for _p in ("hit","miss"): M_DNS_QUERIES.labels(_p)
+
+_DNS_LOG_RE   = re.compile(r"\[(\d+) ([\d.]+)(ms|s|µs|us)\] dns: (exchange failed|exchanged|exchange|cached)\b(.*)")
+_DNS_VIA_RE   = re.compile(r" via ([\w.\-]+)")
+_DNS_ROUTE_RE = re.compile(r"\[(\d+) [^\]]*\] dns: .*=> (?:route\()?([\w.\-]+)\)?\s*$")
+_DNS_UNIT     = {"ms":0.001, "s":1.0, "µs":1e-6, "us":1e-6}
+_DNS_STATE = {"pending":OrderedDict(), "route":OrderedDict(), "lines":0, "connected":False, "error":None, "since":None}
+
+def dns_log_line(line:str):
+    """解析一行日志（Clash API /logs 的 payload），更新计数与耗时直方图"""
+    st=_DNS_STATE; st["lines"]+=1
+    m=_DNS_LOG_RE.search(line)
+    if not m:
+        r=_DNS_ROUTE_RE.search(line)     # "match[..] => route(main-dns)"：没有 via 时用它确定上游
+        if r:
+            st["route"][r.group(1)]=r.group(2)
+            while len(st["route"])>4096: st["route"].popitem(last=False)
+        return
+    cid, t, kind, rest = m.group(1), float(m.group(2))*_DNS_UNIT[m.group(3)], m.group(4), m.group(5)
+    if kind=="cached":
+        M_DNS_QUERIES.inc(M_DNS_QUERIES.labels("hit"))
+    elif kind=="exchange":
+        v=_DNS_VIA_RE.search(rest)
+        st["pending"][cid]=(v.group(1) if v else st["route"].pop(cid, "unknown"), t)
+        while len(st["pending"])>4096: st["pending"].popitem(last=False)
+        M_DNS_QUERIES.inc(M_DNS_QUERIES.labels("miss"))
+    else:
+        p=st["pending"].pop(cid, None)
+        if p is None: return
+        server, t0 = p
+        M_DNS_EXCHANGE.inc(M_DNS_EXCHANGE.labels(server, "ok" if kind=="exchanged" else "fail"))
+        if kind=="exchanged": M_DNS_SECONDS.observe(M_DNS_SECONDS.labels(server), max(0.0, t-t0))
+
+def dns_log_loop():
+    """长连接读 /logs?level=debug（每行一个 JSON）；断开后退避重连。
+    读超时只是这段时间没有日志（空闲或 log.level 不是 debug），直接重连，不算错误"""
+    if not DNSSTAT_ENABLE: return
+    delay=1
+    while not _SHUTDOWN.is_set():
+        headers={"Authorization":f"Bearer {CLASH_SECRET}"} if CLASH_SECRET else {}
+        try:
+            req=urllib.request.Request(f"http://{CLASH_API}/logs?level=debug", headers=headers)
+            with urllib.request.urlopen(req, timeout=60) as r:
+                _DNS_STATE.update(connected=True, error=None, since=_DNS_STATE["since"] or time.time()); delay=1
+                for raw in r:
+                    if _SHUTDOWN.is_set(): break
+                    try: payload=json.loads(raw).get("payload","")
+                    except ValueError: continue
+                    if "dns: " in payload: dns_log_line(payload)
+        except (socket.timeout, TimeoutError):
+            continue             # 连接仍算正常：保留 connected，立即重连
+        except Exception as e:
+            _DNS_STATE["error"]=str(e)
+        _DNS_STATE.update(connected=False, since=None)
+        _SHUTDOWN.wait(delay); delay=min(delay*2, 60)
+
+def dns_probe() -> list:
+    """经 Clash API /dns/query 解析 DNSSTAT_PROBE 里的域名（走 sing-box 的 DNS 路由与缓存），记录端到端耗时"""
+    out=[]
+    for name in DNSSTAT_PROBE:
+        t0=time.perf_counter()
+        try:
+            r=clash_api("GET", f"/dns/query?name={urllib.parse.quote(name)}&type=A", timeout=5) or {}
+            dt=time.perf_counter()-t0
+            M_DNS_PROBE.observe(M_DNS_PROBE.labels(name), dt)
+            out.append({"name":name,"ok":r.get("Status",0)==0,"ms":round(dt*1000,1),
+                        "answer":[a.get("data") for a in r.get("Answer") or []][:4]})
+        except Exception as e:
+            out.append({"name":name,"ok":False,"ms":None,"error":str(e)})
+    _DNS_STATE["probe"]={"ts":time.time(),"results":out}
+    return out
+
+def dns_probe_loop():
+    if not DNSSTAT_ENABLE or DNSSTAT_INTERVAL<=0 or not DNSSTAT_PROBE: return
+    while not _SHUTDOWN.wait(DNSSTAT_INTERVAL):
+        dns_probe()
+
+def hist_quantile(buckets, counts, q:float):
+    """按直方图桶估算分位数（桶内线性插值），单位同 buckets；没有样本返回 None"""
+    total=sum(counts)
+    if not total: return None
+    rank=q*total; acc=0; lo=0.0
+    for le,n in zip(tuple(buckets)+(buckets[-1],), counts):
+        if n and acc+n>=rank: return lo+(le-lo)*((rank-acc)/n)
+        acc+=n; lo=le
+    return buckets[-1]
+
+def dns_stats() -> dict:
+    hit=M_DNS_QUERIES.labels("hit").value; miss=M_DNS_QUERIES.labels("miss").value
+    servers={}
+    for (srv,), c in list(M_DNS_SECONDS.children.items()):
+        with c.lock: counts=list(c.counts); total=c.sum
+        n=sum(counts)
+        q=lambda x: None if n==0 else round(hist_quantile(_DNS_BUCKETS, counts, x)*1000, 1)
+        servers[srv]={"count":n,"avg_ms":round(total/n*1000,1) if n else None,"p50_ms":q(0.5),"p95_ms":q(0.95),
+                      "fail":int(M_DNS_EXCHANGE.labels(srv,"fail").value)}
+    return {"hit":int(hit),"miss":int(miss),"hit_rate":round(hit/(hit+miss),4) if hit+miss else None,
+            "servers":servers,"pending":len(_DNS_STATE["pending"]),"lines":_DNS_STATE["lines"],
+            "connected":_DNS_STATE["connected"],"error":_DNS_STATE["error"],"probe":_DNS_STATE.get("probe")}
+
+# 缓存相关的 dns 顶层选项（sing-box 原生字段）；disable_expire=true 时过期记录仍直接返回（即“旧记录兜底”）
+DNS_CACHE_OPTS = {"cache_capacity":int, "disable_cache":bool, "disable_expire":bool, "independent_cache":bool}
+
+def dns_cache_opts(cfg:dict) -> dict:
+    dns=cfg.get("dns") or {}
+    return {**{k:dns.get(k) for k in DNS_CACHE_OPTS}, "log_level":(cfg.get("log") or {}).get("level")}
+
+def dns_cache_apply(opts:dict) -> dict:
+    """改写 dns 缓存选项（以及 log_level），check 通过后重启 sing-box。None 表示删除该字段（恢复默认）"""
+    with _APPLY_LOCK:     # 与切换节点、规则集同步共用 SB_CFG.new
+        return _dns_cache_apply(opts)
+
+def _dns_cache_apply(opts:dict) -> dict:
+    cfg=cfg_editable(); dns=cfg["dns"]=dict(cfg.get("dns") or {})
+    for k,typ in DNS_CACHE_OPTS.items():
+        if k not in opts: continue
+        if opts[k] is None: dns.pop(k, None)
+        elif typ is int:
+            v=int(opts[k])
+            if v<1024: return {"ok":False,"msg":"cache_capacity 不能小于 1024"}
+            dns[k]=v
+        else: dns[k]=bool(opts[k])
+    if opts.get("log_level"): cfg["log"]=dict(cfg.get("log") or {}, level=str(opts["log_level"]))
+    if cfg["dns"]==(cfg_load().get("dns") or {}) and not opts.get("log_level"):
+        return {"ok":True,"msg":"未改变","cache":dns_cache_opts(cfg)}
+    ok1, out1, err1 = cfg_write_checked(cfg)
+    if not ok1: return {"ok":False,"msg":"sing-box check 未通过，配置未改动","stdout":out1,"stderr":err1}
+    ok2, out2, err2 = unit_action("restart")
+    return {"ok":ok2,"msg":"已写入并重启" if ok2 else "已写入，重启失败","stdout":out2,"stderr":err2,"cache":dns_cache_opts(cfg)}
+
+@app.route("/api/dns", methods=["POST"])
+def api_dns():
+    """{} 返回统计与缓存选项；{"probe":true} 立即探测；{"cache":{...}} 修改缓存选项；{"reset":true} 清零计数"""
+    ok_auth, resp = must_auth()
+    if not ok_auth: return resp
+    data=request.get_json(force=True, silent=True) or {}
+    if isinstance(data.get("cache"), dict): return respond(dns_cache_apply(data["cache"]))
+    if data.get("reset"):
+        for M in (M_DNS_QUERIES, M_DNS_EXCHANGE, M_DNS_SECONDS, M_DNS_PROBE):
+            with M.lock: M.children.clear()
+        for _p in ("hit","miss"): M_DNS_QUERIES.labels(_p)
+    if data.get("probe"): dns_probe()
+    return ok("dns", stats=dns_stats(), cache=dns_cache_opts(cfg_load()))
+
+def start_background():
+    """后台线程（仅在作为服务运行时启动）"""
+    metrics_start()
+    threading.Thread(target=failover_loop, name="failover", daemon=True).start()
+    threading.Thread(target=traffic_loop, name="traffic", daemon=True).start()
+    threading.Thread(target=ruleset_loop, name="ruleset", daemon=True).start()
+    threading.Thread(target=dns_log_loop, name="dnslog", daemon=True).start()
+    threading.Thread(target=dns_probe_loop, name="dnsprobe", daemon=True).start()
+
+# ====== 服务器 ======
+def _wait_drain(busy):
+    """优雅退出：等进行中的请求与后台任务结束，最多 WEB_GRACE 秒，然后把计数落盘"""
+    deadline=time.time()+WEB_GRACE
+    while time.time()<deadline and (busy() or any(j["state"] in ("queued","running") for j in list(_JOBS.values()))):
+        time.sleep(0.2)
+    try: traffic_save()
+    except Exception: pass
+    state_flush()
+
+def serve_prod():
+    """生产模式：有 waitress 时用它（线程池 + HTTP/1.1 keep-alive），否则用 werkzeug 的线程池服务器。
+    SIGTERM/SIGINT 时停止接收新连接，等待进行中的请求和任务最多 WEB_GRACE 秒"""
+    if WEB_WORKERS>1:
+        print("sb-web: 任务/缓存/采样都在进程内，SB_WEB_WORKERS>1 不受支持，按 1 个进程运行")
+    try:
+        from waitress.server import create_server
+    except ImportError:
+        create_server=None
+    if create_server:
+        # send_bytes=1：SSE 每一帧立即发出，不攒缓冲
+        srv=create_server(app, host=HOST, port=PORT, threads=WEB_THREADS, channel_timeout=WEB_KEEPALIVE,
+                          send_bytes=1, ident="sb-web")
+        def stop(signum, frame):
+            _SHUTDOWN.set(); srv.close()
+        signal.signal(signal.SIGTERM, stop); signal.signal(signal.SIGINT, stop)
+        print(f"sb-web: serving on http://{HOST}:{PORT} (waitress, threads={WEB_THREADS})")
+        try: srv.run()
+        except (OSError, ValueError): pass       # close() 后 select 在已关闭的 socket 上返回
+        _wait_drain(lambda: srv.task_dispatcher.queue or srv.task_dispatcher.active_count)
+        srv.task_dispatcher.shutdown()
+        return
+
+    from werkzeug.serving import BaseWSGIServer, WSGIRequestHandler
+    class PoolServer(BaseWSGIServer):
+        # werkzeug 的处理器每个响应后都会关闭连接，这里只提供固定大小的线程池
+        def __init__(self):
+            super().__init__(HOST, PORT, app, handler=WSGIRequestHandler)
+            self.pool=ThreadPoolExecutor(max_workers=WEB_THREADS, thread_name_prefix="http")
+            self.inflight=0; self.lock=threading.Lock()
+        def process_request(self, req, addr):
+            with self.lock: self.inflight+=1
+            self.pool.submit(self.work, req, addr)
+        def work(self, req, addr):
+            try: self.finish_request(req, addr)
+            except Exception: self.handle_error(req, addr)
+            finally:
+                self.shutdown_request(req)
+                with self.lock: self.inflight-=1
+
+    srv=PoolServer()
+    def stop(signum, frame):
+        _SHUTDOWN.set()
+        threading.Thread(target=srv.shutdown, daemon=True).start()
+    signal.signal(signal.SIGTERM, stop); signal.signal(signal.SIGINT, stop)
+    print(f"sb-web: serving on http://{HOST}:{PORT} (werkzeug, threads={WEB_THREADS})")
+    srv.serve_forever()
+    _wait_drain(lambda: srv.inflight)
+    srv.server_close()
+
 if __name__ == "__main__":
-    app.run(host=HOST, port=PORT)
\ No newline at end of file
+    if len(sys.argv)>1: sys.exit(net_cli(sys.argv[1:]))
+    start_background()
+    if WEB_SERVER=="prod": serve_prod()
+    else: app.run(host=HOST, port=PORT)
\ No newline at end of file